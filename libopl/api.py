@@ -8,12 +8,22 @@
 # Config Example: https://github.com/Nold360/libopl/example.opl.ini
 from os import path
 from libopl.artwork import Artwork
+from libopl.cache import ArtworkCache
 from libopl.common import slugify, exists, config
+from libopl.db import MetadataDB, normalize_serial
+from libopl.async_api import AsyncAPI
+from libopl.httpclient import HTTPClient, AIMDLimiter, APIUnavailable
+from libopl.transcode import Transcoder
+from libopl import throttle
 
 import re
 import json
+import asyncio
+import threading
 import requests
 import unicodedata
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
 
 class API():
     # API Version
@@ -29,9 +39,49 @@ class API():
     STATIC_URL=None
     config = None
 
-    def __init__(self):
+    # Optional endpoint taking {"ids": [...]}, returning a list of metadata
+    BATCH_URL=None
+
+    # Max. parallel requests (get_metadata_many)
+    concurrency = AsyncAPI.CONCURRENCY
+
+    # RateLimiter for requests/s
+    limiter = None
+
+    # Offline MetadataDB, looked up before asking the API
+    db = None
+
+    # Shared ArtworkCache, only downloads on a miss
+    cache = None
+
+    # Optional Transcoder, resizes artwork to OPL's recommended formats
+    transcoder = None
+
+    def __init__(self, limiter=None, db=None, cache=None, transcode=False):
+        self.limiter = limiter if limiter else throttle.http
+        self.db = db if db else MetadataDB.open()
+        self.cache = cache
+        if transcode:
+            self.enable_transcoding()
         self.URL=config("API", "URL")
         self.STATIC_URL=config("API", "STATIC_URL")
+        self.BATCH_URL=config("API", "BATCH_URL")
+        self.concurrency = config("API", "CONCURRENCY") or AsyncAPI.CONCURRENCY
+
+        # Metadata already resolved in this session, by normalized ID
+        self.metadata = {}
+
+        # Keep-alive connections, one per concurrent request by default
+        self.session = requests.Session()
+        pool_size = config("API", "POOL_SIZE") or self.concurrency
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Timeouts, retries, adaptive concurrency & circuit breaker per host,
+        # so a failing metadata API doesn't block artwork downloads & vice versa
+        self.clients = {}
+        self.clients_lock = threading.Lock()
             
         if not self.URL or not self.STATIC_URL:
             print("""
@@ -43,23 +93,93 @@ Example: http://github.com/Nold360/libopl/example.opl.ini
 """)
         else:
             self.enabled = True
-            
+
+    # HTTPClient for the host of url
+    def get_client(self, url):
+        host = urlsplit(url).netloc
+        with self.clients_lock:
+            if host not in self.clients:
+                self.clients[host] = HTTPClient(self.session, self.limiter, \
+                        AIMDLimiter(self.concurrency), timeout=config("API", "TIMEOUT"), \
+                        retries=config("API", "RETRIES"))
+            return self.clients[host]
+
+    # Throttled GET-request with retries, POST if data is given
+    # Raises APIUnavailable while url's host is down
+    def request(self, url, data=None):
+        client = self.get_client(url)
+        if data is not None:
+            return client.post(url, data=data, headers={"Content-Type": "application/json"})
+        return client.get(url)
+
+    # Metadata API is down, only cached data/offline database are used for now
+    def is_offline(self):
+        return bool(self.URL) and self.get_client(self.URL).breaker.is_open()
+
+    # Metadata resolved earlier or from offline database
+    # returns json-dict or None
+    def lookup_metadata(self, title_id):
+        meta = self.metadata.get(normalize_serial(title_id))
+        if meta:
+            return meta
+        if self.db:
+            meta = self.db.get(title_id)
+            if meta:
+                self.metadata[normalize_serial(title_id)] = meta
+            return meta
+        return None
+
+    # Keep metadata for later lookups, by all IDs it is known under
+    def remember_metadata(self, meta, title_id=None):
+        if not isinstance(meta, dict):
+            return
+        for key in [title_id, meta.get("id"), meta.get("opl_id")]:
+            if key:
+                self.metadata[normalize_serial(key)] = meta
 
     # Get metadata for title_id
+    # Offline database first, API second
     # returns json-dict
     def get_metadata(self, title_id):
+        meta = self.lookup_metadata(title_id)
+        if meta:
+            return meta
+        return self.fetch_metadata(title_id)
+
+    # Get metadata for many title_ids at once, with parallel requests
+    # Don't call from a running event loop, use AsyncAPI there.
+    # returns dict of title_id: json-dict
+    def get_metadata_many(self, title_ids):
+        aapi = AsyncAPI(self)
+        try:
+            return asyncio.run(aapi.get_metadata_many(title_ids))
+        finally:
+            aapi.close()
+
+    # Get metadata for title_id from API
+    # returns json-dict
+    def fetch_metadata(self, title_id):
         if not self.enabled:
             return False
 
         try:
-            r = requests.get(self.URL + title_id)
+            r = self.request(self.URL + title_id)
+        except APIUnavailable:
+            return False
         except Exception as e:
             print("Oops! Error while downloading metadata from API:")
             print(e)
             return False
+        # Error bodies (404, 429, ...) aren't metadata & mustn't be cached,
+        # 429 & 5xx have already been retried (honoring Retry-After)
+        if not 200 <= r.status_code < 300:
+            if r.status_code != 404:
+                print("Oops! API returned HTTP %d for '%s'" % (r.status_code, title_id))
+            return False
 
         try:
             json_data = json.loads(r.text)
+            self.remember_metadata(json_data, title_id)
             return json_data
         except:
             print("Oops! API didn't return JSON?")
@@ -72,12 +192,15 @@ Example: http://github.com/Nold360/libopl/example.opl.ini
         if not self.enabled:
             return False
 
-        artworks = []
         meta = game.get("meta")
         if not meta or not 'artwork' in meta.keys():
             print("Oops: No Artworks found in Metadata.")
             return None
+        return self.artwork_from_meta(meta)
 
+    # Artwork Objects from metadata json-dict
+    def artwork_from_meta(self, meta):
+        artworks = []
         for art_type in meta["artwork"]:
             if type(meta["artwork"][art_type]) == list:
                 filename = meta["artwork"][art_type][0]
@@ -86,7 +209,70 @@ Example: http://github.com/Nold360/libopl/example.opl.ini
             a = Artwork(self.STATIC_URL + "artwork/" + filename, art_type, filetype=filetype)
             artworks.append(a)
         return artworks
-        
+
+    # Lazily open shared artwork cache
+    def get_cache(self):
+        if not self.cache:
+            try:
+                self.cache = ArtworkCache()
+            except Exception as e:
+                print("Warn: Couldn't open artwork cache:")
+                print(e)
+                self.cache = False
+        return self.cache
+
+    # Resize/re-encode downloaded artwork from now on
+    def enable_transcoding(self, workers=None):
+        if not Transcoder.available():
+            print("Warn: Pillow isn't installed, artwork won't be resized.")
+            return False
+        self.transcoder = Transcoder(self.get_cache(), workers)
+        return True
+
+    # Download artwork for url, using the cache
+    # Return: content or None
+    def fetch_artwork(self, url):
+        cache = self.get_cache()
+        if cache:
+            filepath = cache.get(url)
+            if filepath:
+                with open(filepath, 'rb') as f:
+                    return f.read()
+
+        try:
+            r = self.request(url)
+        except APIUnavailable:
+            print(" -> Skipped: Artwork host unavailable & not in cache")
+            return None
+        if r.status_code != 200:
+            print(" -> Error downloading artwork: HTTP %d" % r.status_code)
+            return None
+        if cache:
+            cache.put(url, r.content)
+        return r.content
+
+    # Warm artwork cache for opl_id, no opl_drive needed
+    # Return: Number of failed downloads
+    def prefetch_artwork(self, opl_id):
+        if not self.enabled:
+            return False
+
+        meta = self.get_metadata(opl_id)
+        if not meta or not 'artwork' in meta.keys():
+            print("No Artwork available for '%s'." % opl_id)
+            return 0
+
+        ret = 0
+        for art in self.artwork_from_meta(meta):
+            try:
+                if not self.fetch_artwork(art.url):
+                    ret += 1
+            except Exception as e:
+                print(" -> Error downloading artwork:")
+                print(e)
+                ret += 1
+        return ret
+
     # Download Artwork for "game" to "opl_drive"/ART/
     # Return: Number of failed downloads/writes
     def download_artwork(self, game, opl_drive, override=False):
@@ -104,31 +290,64 @@ Example: http://github.com/Nold360/libopl/example.opl.ini
             print("No artwork to download...")
             return False
 
+        # Artwork waiting for transcoder: (art, filepath, content)
+        pending = []
+
         for art in game.get("artwork"):
-            filename = filebase + "_" + art.type + "." + art.filetype
+            filetype = art.filetype
+            if self.transcoder:
+                filetype = self.transcoder.filetype(art.type, art.filetype)
+            filename = filebase + "_" + art.type + "." + filetype
             filepath = path.join(opl_drive, "ART", filename)
             if exists(filepath) and not override:
                 print("Skipped: %s (File exists)" % filename)
                 continue
 
+            cache = self.get_cache()
+            if not self.transcoder and cache and cache.install(art.url, filepath):
+                print("From Cache: " + filename)
+                continue
+
             print("Downloading Artwork: " + filename)
             try:
-                r = requests.get(art.url)
+                content = self.fetch_artwork(art.url)
             except Exception as e: 
                 print(" -> Error downloading artwork:")
                 print(e)
                 ret+=1
                 continue
-
-            try:
-                if not exists(filepath) or override:
-                    with open(filepath, 'wb') as f:
-                        f.write(r.content)
-            except Exception as e: 
-                print(" -> Error writing artwork to opl_drive:")
-                print(e)
+            if content is None:
                 ret+=1
                 continue
 
+            if self.transcoder and self.transcoder.supports(art.type):
+                pending.append((art, filepath, content))
+                continue
+
+            ret += self.__write_artwork(filepath, content, override)
+
+        # Transcode all at once in parallel, fall back to the original image on error
+        if pending:
+            print("Resizing %d Artwork(s)..." % len(pending))
+            results = self.transcoder.transcode_many([(c, a.type) for a, f, c in pending])
+            for (art, filepath, content), data in zip(pending, results):
+                if data is None:
+                    data = content
+                    filepath = path.join(opl_drive, "ART", filebase + "_" + art.type + "." + art.filetype)
+                ret += self.__write_artwork(filepath, data, override)
+
         print("Download completed!")
         return ret
+
+    # Write artwork to opl_drive
+    # Return: 1 on error, 0 on success
+    def __write_artwork(self, filepath, content, override=False):
+        try:
+            if not exists(filepath) or override:
+                with open(filepath, 'wb') as f:
+                    f.write(content)
+        except Exception as e: 
+            print(" -> Error writing artwork to opl_drive:")
+            print(e)
+            return 1
+        return 0
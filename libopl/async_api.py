@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+#####
+# Async API Client
+# Resolves metadata of many games at once, instead of one blocking
+# round trip per game:
+#  - bounded number of requests in flight ("concurrency")
+#  - concurrent lookups of the same ID share one request
+#  - uses the batch endpoint (API.BATCH_URL) if the server has one
+#
+# Wraps a (sync) API object & shares its session, database & results.
+#
+#   metadata = asyncio.run(AsyncAPI(api).get_metadata_many(ids))
+# or simply:
+#   metadata = api.get_metadata_many(ids)
+from concurrent.futures import ThreadPoolExecutor
+from libopl.db import normalize_serial
+
+import asyncio
+import json
+
+
+class AsyncAPI():
+    # Max. requests in flight
+    CONCURRENCY = 8
+
+    # Max. IDs per batch request
+    BATCH_SIZE = 100
+
+    api = None
+    concurrency = None
+
+    def __init__(self, api, concurrency=None):
+        self.api = api
+        self.concurrency = concurrency if concurrency else api.concurrency
+        self.semaphore = None
+        self.executor = None
+        # normalized ID: asyncio.Future
+        self.inflight = {}
+
+    # Blocking calls of the sync API run in this thread pool
+    async def __run(self, func, *args):
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    # Get metadata for title_id
+    # returns json-dict, False/None if not found
+    async def get_metadata(self, title_id):
+        key = normalize_serial(title_id)
+        cached = self.api.lookup_metadata(title_id)
+        if cached:
+            return cached
+
+        # Same ID is already being fetched, wait for that request
+        if key in self.inflight:
+            return await asyncio.shield(self.inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            if not self.semaphore:
+                self.semaphore = asyncio.Semaphore(self.concurrency)
+            async with self.semaphore:
+                meta = await self.__run(self.api.fetch_metadata, title_id)
+            future.set_result(meta)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self.inflight[key]
+        return meta
+
+    # Fetch metadata of up to BATCH_SIZE IDs with a single request
+    # Return: list of json-dicts
+    async def __get_batch(self, title_ids):
+        if not self.semaphore:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            r = await self.__run(self.api.request, self.api.BATCH_URL, \
+                    json.dumps({"ids": title_ids}))
+        if not 200 <= r.status_code < 300:
+            raise ValueError("API returned HTTP %d" % r.status_code)
+        data = json.loads(r.text)
+        if isinstance(data, dict):
+            data = list(data.values())
+        return [m for m in data if isinstance(m, dict)]
+
+    # Get metadata for many title_ids
+    # returns dict of title_id: json-dict (False/None if not found)
+    async def get_metadata_many(self, title_ids):
+        title_ids = list(dict.fromkeys(i for i in title_ids if i))
+        results = {}
+        missing = []
+        for title_id in title_ids:
+            meta = self.api.lookup_metadata(title_id)
+            if meta:
+                results[title_id] = meta
+            else:
+                missing.append(title_id)
+
+        if missing and self.api.enabled and self.api.BATCH_URL:
+            batches = [missing[i:i+AsyncAPI.BATCH_SIZE] \
+                    for i in range(0, len(missing), AsyncAPI.BATCH_SIZE)]
+            for batch in await asyncio.gather(*[self.__get_batch(b) for b in batches], \
+                    return_exceptions=True):
+                if isinstance(batch, Exception):
+                    print("Oops! Error while downloading metadata batch from API:")
+                    print(batch)
+                    continue
+                for meta in batch:
+                    self.api.remember_metadata(meta)
+            for title_id in missing:
+                results[title_id] = self.api.lookup_metadata(title_id)
+            missing = [i for i in missing if not results[i]]
+
+        metas = await asyncio.gather(*[self.get_metadata(i) for i in missing], \
+                return_exceptions=True)
+        for title_id, meta in zip(missing, metas):
+            if isinstance(meta, Exception):
+                print("Oops! Error while downloading metadata for '%s':" % title_id)
+                print(meta)
+                meta = False
+            results[title_id] = meta
+        return results
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+###
+# Batch Jobs
+# Runs a manifest of operations against one or more drives in one process,
+# sharing the API (HTTP session, metadata), ul.cfg handles & directory
+# listings of a single POPLManager.
+#
+# Manifest (JSON):
+#   {
+#     "opl_drive": "/media/usb",          <- default for all jobs (optional)
+#     "workers": 4,                       <- parallel jobs (optional, --workers wins)
+#     "jobs": [
+#       {"id": "init", "op": "init"},
+#       {"op": "add", "src_file": ["a.iso", "b.iso"], "ul": true},
+#       {"op": "convert", "opl_drive": "/media/usb2", "game": "SLUS_209.46", "to": "iso"},
+#       {"op": "artwork", "after": ["init"]}
+#     ]
+#   }
+#
+# Jobs on the same drive run in manifest order, jobs on different drives in
+# parallel. "after" adds dependencies on other job ids (e.g. across drives).
+# Jobs depending on a failed job are skipped, dependency cycles are rejected.
+# Every drive's ul.cfg is read once & written once after all jobs are done.
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import os
+import json
+import argparse
+
+
+class BatchJob():
+    # Options & their defaults per operation, same as on the cli
+    OPS = {
+        "init": {},
+        "add": {"src_file": None, "rename": False, "force": False, "ul": False, "resize": False,
+                "sync": "interval", "sync_interval": 64},
+        "delete": {"opl_id": None},
+        "fix": {"dry_run": False, "resume": False, "rollback": False},
+        "artwork": {"force": False, "resize": False},
+        "convert": {"game": None, "to": None, "keep": False, "out": None, "title": None},
+    }
+
+    # Operations that change files on the drive
+    WRITES = ["init", "add", "delete", "fix", "convert"]
+
+    id = None
+    op = None
+    after = None
+
+    def __init__(self, id, op, options, after=None):
+        self.id = id
+        self.op = op
+        self.options = options
+        self.after = after if after else []
+        # ok, failed, skipped
+        self.status = None
+
+    # Return: argparse.Namespace for the POPLManager method
+    def args(self):
+        return argparse.Namespace(**self.options)
+
+    def drive(self):
+        return os.path.realpath(self.options["opl_drive"])
+
+
+class BatchRunner():
+    workers = 4
+
+    opl = None
+
+    # opl: POPLManager
+    # workers: from the cli, takes precedence over the manifest's
+    def __init__(self, opl, workers=None):
+        self.opl = opl
+        self.cli_workers = workers
+        if workers:
+            self.workers = workers
+        self.jobs = []
+
+    # Read & validate manifest
+    # Return: True if the manifest is valid
+    def load(self, filepath):
+        try:
+            with open(filepath, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print("Error: Couldn't read manifest '%s'" % filepath)
+            print(e)
+            return False
+        if isinstance(manifest, list):
+            manifest = {"jobs": manifest}
+        if manifest.get("workers") and not self.cli_workers:
+            self.workers = int(manifest["workers"])
+
+        ok = True
+        for i, job in enumerate(manifest.get("jobs", [])):
+            id = str(job.get("id", i))
+            op = job.get("op")
+            if op not in BatchJob.OPS:
+                print("Error: Job '%s' has unknown op '%s', use one of: %s" \
+                        % (id, op, ", ".join(BatchJob.OPS)))
+                ok = False
+                continue
+
+            options = dict(BatchJob.OPS[op])
+            options["opl_drive"] = manifest.get("opl_drive")
+            for key, value in job.items():
+                if key in ["id", "op", "after"]:
+                    continue
+                if key not in options:
+                    print("Error: Job '%s': unknown option '%s' for '%s'" % (id, key, op))
+                    ok = False
+                options[key] = value
+            missing = [k for k, v in options.items() if v is None and \
+                    k in ["opl_drive", "src_file", "opl_id", "game", "to"]]
+            if missing:
+                print("Error: Job '%s': missing %s" % (id, ", ".join(missing)))
+                ok = False
+                continue
+            for key in ["src_file", "opl_id"]:
+                if isinstance(options.get(key), str):
+                    options[key] = [options[key]]
+            if not os.path.isdir(options["opl_drive"]):
+                print("Error: Job '%s': opl_drive '%s' doesn't exist!" % (id, options["opl_drive"]))
+                ok = False
+                continue
+            self.jobs.append(BatchJob(id, op, options, job.get("after")))
+
+        ids = [j.id for j in self.jobs]
+        if len(set(ids)) != len(ids):
+            print("Error: Job ids must be unique")
+            ok = False
+        for job in self.jobs:
+            for dep in job.after:
+                if str(dep) not in ids:
+                    print("Error: Job '%s' depends on unknown job '%s'" % (job.id, dep))
+                    ok = False
+        if ok:
+            cycle = self.__find_cycle()
+            if cycle:
+                print("Error: Jobs depend on each other: %s" % " -> ".join(cycle))
+                print("(Jobs on the same drive also wait for the ones before them)")
+                ok = False
+        return ok
+
+    # Return: list of job ids forming a dependency cycle (first id repeated
+    # at the end) or None
+    def __find_cycle(self):
+        deps = self.dependencies()
+        # 1: being visited, 2: done
+        state = {}
+        for start in deps:
+            if start in state:
+                continue
+            path = [start]
+            stack = [iter(sorted(deps[start]))]
+            state[start] = 1
+            while stack:
+                dep = next(stack[-1], None)
+                if dep is None:
+                    state[path.pop()] = 2
+                    stack.pop()
+                elif state.get(dep) == 1:
+                    return path[path.index(dep):] + [dep]
+                elif dep not in state:
+                    state[dep] = 1
+                    path.append(dep)
+                    stack.append(iter(sorted(deps[dep])))
+        return None
+
+    # Return: dict of job id: set of job ids it waits for
+    def dependencies(self):
+        deps = {}
+        last = {}
+        for job in self.jobs:
+            deps[job.id] = set(str(d) for d in job.after)
+            # Serialize jobs on the same drive
+            if job.drive() in last:
+                deps[job.id].add(last[job.drive()])
+            last[job.drive()] = job.id
+        return deps
+
+    def __run_job(self, job):
+        print("\n[%s] %s %s" % (job.id, job.op, job.options["opl_drive"]))
+        func = {
+            "init": self.opl.init,
+            "add": self.opl.add,
+            "delete": self.opl.delete,
+            "fix": self.opl.fix,
+            "artwork": self.opl.download_artwork,
+            "convert": self.opl.convert,
+        }[job.op]
+        try:
+            # Some operations don't return anything
+            ok = func(job.args()) is not False
+        finally:
+            if job.op in BatchJob.WRITES:
+                self.opl.invalidate(job.options["opl_drive"])
+        return ok
+
+    # Run all jobs, writing ul.cfg's at the end
+    # Return: True if all jobs succeeded
+    def run(self):
+        deps = self.dependencies()
+        jobs = dict((j.id, j) for j in self.jobs)
+        dependents = dict((id, []) for id in jobs)
+        for id, d in deps.items():
+            for dep in d:
+                dependents[dep].append(id)
+        waiting = dict((id, len(d)) for id, d in deps.items())
+
+        self.opl.begin_batch()
+        running = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                ready = [id for id in jobs if waiting[id] == 0]
+                while ready or running:
+                    for id in ready:
+                        running[executor.submit(self.__run_job, jobs[id])] = id
+                    ready = []
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        id = running.pop(future)
+                        try:
+                            jobs[id].status = "ok" if future.result() else "failed"
+                        except Exception as e:
+                            print("Error in job '%s':" % id)
+                            print(e)
+                            jobs[id].status = "failed"
+                        ready += self.__release(id, jobs, dependents, waiting)
+        finally:
+            self.opl.end_batch()
+
+        # Never started, cycles are rejected by load()
+        for job in self.jobs:
+            if not job.status:
+                job.status = "skipped"
+
+        print("\nBatch summary:")
+        for job in self.jobs:
+            print(" [%-7s] %s: %s %s" % (job.status, job.id, job.op, job.options["opl_drive"]))
+        return all(j.status == "ok" for j in self.jobs)
+
+    # Job "id" finished, return ids of jobs that can start now.
+    # Dependents of failed jobs are skipped (recursively).
+    def __release(self, id, jobs, dependents, waiting):
+        ready = []
+        for dep in dependents[id]:
+            if jobs[id].status != "ok":
+                if not jobs[dep].status:
+                    print("Skipping job '%s', '%s' %s" % (dep, id, jobs[id].status))
+                    jobs[dep].status = "skipped"
+                    ready += self.__release(dep, jobs, dependents, waiting)
+                continue
+            waiting[dep] -= 1
+            if waiting[dep] == 0 and not jobs[dep].status:
+                ready.append(dep)
+        return ready
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+#####
+# Artwork Cache
+# Content-addressed store shared by all drives:
+#  - objects/<sha256[:2]>/<sha256> holds the actual image data,
+#    identical images from different URLs are stored once
+#  - index.db maps source URL -> content hash & tracks last access
+#  - least recently used entries are evicted when "max_size" is exceeded
+#
+# Config Example: https://github.com/Nold360/libopl/example.opl.ini
+from pathlib import Path
+from libopl.common import is_file, is_dir, config
+from libopl.fileio import reflink
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class ArtworkCache():
+    DEFAULT_PATH = str(Path.home()) + "/.cache/libopl/artwork"
+
+    # Default size cap: 1GB
+    DEFAULT_MAX_SIZE = 1024
+
+    path = None
+    max_size = None
+    conn = None
+
+    def __init__(self, path=None, max_size=None):
+        if not path:
+            path = config("CACHE", "PATH") or ArtworkCache.DEFAULT_PATH
+        if not max_size:
+            max_size = config("CACHE", "MAX_SIZE") or ArtworkCache.DEFAULT_MAX_SIZE
+        self.path = path
+        self.max_size = max_size << 20
+        self.lock = threading.Lock()
+
+        if not is_dir(os.path.join(self.path, "objects")):
+            os.makedirs(os.path.join(self.path, "objects"))
+        self.conn = sqlite3.connect(os.path.join(self.path, "index.db"), check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                hash TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                atime REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS urls_atime ON urls (atime);
+            CREATE INDEX IF NOT EXISTS urls_hash ON urls (hash);
+        """)
+        self.conn.commit()
+
+    def object_path(self, digest):
+        return os.path.join(self.path, "objects", digest[:2], digest)
+
+    # Return: path to cached object for url or None on miss
+    def get(self, url):
+        with self.lock:
+            row = self.conn.execute("SELECT hash FROM urls WHERE url = ?", (url,)).fetchone()
+            if not row:
+                return None
+            filepath = self.object_path(row[0])
+            if not is_file(filepath):
+                # Object vanished, forget about it
+                with self.conn:
+                    self.conn.execute("DELETE FROM urls WHERE url = ?", (url,))
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE urls SET atime = ? WHERE url = ?", (time.time(), url))
+            return filepath
+
+    # Store content downloaded from url
+    # Return: path to cached object
+    def put(self, url, content):
+        digest = hashlib.sha256(content).hexdigest()
+        filepath = self.object_path(digest)
+        with self.lock:
+            if not is_file(filepath):
+                if not is_dir(os.path.dirname(filepath)):
+                    os.makedirs(os.path.dirname(filepath))
+                tmp = filepath + ".tmp"
+                with open(tmp, 'wb') as f:
+                    f.write(content)
+                os.replace(tmp, filepath)
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO urls (url, hash, size, atime) " \
+                        "VALUES (?, ?, ?, ?)", (url, digest, len(content), time.time()))
+            self.__evict()
+        return filepath
+
+    # Copy cached object for url to dest (reflink where supported)
+    # Return: True on cache hit
+    def install(self, url, dest):
+        filepath = self.get(url)
+        if not filepath:
+            return False
+        try:
+            reflink(filepath, dest)
+        except OSError as e:
+            print(" -> Error copying artwork from cache:")
+            print(e)
+            return False
+        return True
+
+    # Total size of all stored objects
+    def size(self):
+        row = self.conn.execute("SELECT SUM(size) FROM (SELECT DISTINCT hash, size FROM urls)").fetchone()
+        return row[0] or 0
+
+    # Drop least recently used urls & unreferenced objects until below max_size
+    def __evict(self):
+        total = self.size()
+        if total <= self.max_size:
+            return
+        for url, digest, size in self.conn.execute( \
+                "SELECT url, hash, size FROM urls ORDER BY atime").fetchall():
+            with self.conn:
+                self.conn.execute("DELETE FROM urls WHERE url = ?", (url,))
+            if self.conn.execute("SELECT 1 FROM urls WHERE hash = ?", (digest,)).fetchone():
+                continue
+            try:
+                os.remove(self.object_path(digest))
+            except OSError:
+                pass
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
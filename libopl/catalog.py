@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+###
+# Drive Catalog
+# Lightweight inventory of an opl_drive, built from directory listings
+# & ul.cfg only. No game images are opened/read.
+from libopl.common import is_file, is_dir, usba_crc32
+from libopl.game import Game
+from libopl.ul import ULConfig
+
+import os
+import re
+
+
+# Serial in OPL-Format, e.g. "SLES-12345" -> "SLES_123.45"
+# Same as Game.gen_opl_id(), without needing a Game object
+def to_opl_id(serial):
+    oplid = serial.replace('-', '_').replace('.', '')
+    return (oplid[:8] + "." + oplid[8:]).upper()
+
+
+####
+# Single game (ISO file or ul.cfg entry) on a drive
+class CatalogEntry():
+    ISO = "iso"
+    UL = "ul"
+
+    def __init__(self, type, key, opl_id, title, filename, size=0, mtime=0, parts=None, crc32=0):
+        self.type = type
+        # Unique within drive: relative path (ISO) or region code (UL)
+        self.key = key
+        self.opl_id = opl_id
+        self.title = title
+        self.filename = filename
+        self.size = size
+        # ns, ISO only
+        self.mtime = mtime
+        # UL only: {part_number: size} & CRC32 of the title
+        self.parts = parts if parts else {}
+        self.crc32 = crc32
+
+    def __repr__(self):
+        return "<CatalogEntry %s %s>" % (self.type, self.key)
+
+
+####
+# All games on an opl_drive
+class DriveCatalog():
+    # Folders containing ISO-Games
+    ISO_DIRS = ['CD', 'DVD']
+
+    # Pattern: ul.{CRC32(title)}.{OPL_ID}.{PART}
+    ul_regex = re.compile(r'^ul\.([0-9A-Fa-f]{8})\.(.*)\.([0-9A-Fa-f]{2})$')
+    iso_regex = re.compile(r'.*\.[iI][sS][oO]$')
+    # Pattern: ART/{OPL_ID}_{type}.{ext}
+    art_regex = re.compile(r'^(' + Game.id_regex.pattern + r')_([A-Za-z0-9]+)\.([A-Za-z0-9]+)$', \
+            re.IGNORECASE)
+
+    opl_drive = None
+    entries = None
+
+    # UL-part files found in drive root:
+    #  (CRC32, OPL_ID): {part_number: size}
+    ul_parts = None
+
+    def __init__(self, opl_drive):
+        self.opl_drive = opl_drive
+        self.entries = {}
+        self.ul_parts = {}
+
+    # Cheap fingerprint of the drive's contents: mtimes of game folders & ul.cfg
+    # Changes whenever games are added, removed or renamed
+    def signature(self):
+        sig = []
+        for f in self.ISO_DIRS + ['ul.cfg', '.']:
+            filepath = os.path.join(self.opl_drive, f)
+            try:
+                sig.append("%s:%d" % (f, os.stat(filepath).st_mtime_ns))
+            except OSError:
+                sig.append("%s:-" % f)
+        return ",".join(sig)
+
+    # Scan drive, returns dict of key: CatalogEntry
+    def scan(self):
+        self.entries = {}
+        for dir in self.ISO_DIRS:
+            self.scan_iso_dir(dir)
+        self.scan_ul()
+        return self.entries
+
+    # Entry for ISO "name" in folder "dir", st: its os.stat_result
+    @staticmethod
+    def iso_entry(dir, name, st):
+        ids = Game.id_regex.findall(name[:-4])
+        opl_id = None
+        title = name[:-4]
+        if ids:
+            opl_id = to_opl_id(ids[0])
+            title = Game.id_regex.sub('', title).strip('._-\\ ')
+        return CatalogEntry(CatalogEntry.ISO, dir + "/" + name, opl_id, title, \
+                name, st.st_size, st.st_mtime_ns)
+
+    # Return: list of CatalogEntry for ISOs in folder "dir"
+    def scan_iso_dir(self, dir):
+        entries = []
+        dirpath = os.path.join(self.opl_drive, dir)
+        if not is_dir(dirpath):
+            return entries
+        with os.scandir(dirpath) as it:
+            for f in it:
+                if not self.iso_regex.match(f.name) or not f.is_file():
+                    continue
+                entry = DriveCatalog.iso_entry(dir, f.name, f.stat())
+                self.entries[entry.key] = entry
+                entries.append(entry)
+        return entries
+
+    # Part files in drive root
+    # Return: {(CRC32, OPL_ID): {part_number: size}}
+    def scan_ul_parts(self):
+        self.ul_parts = {}
+        with os.scandir(self.opl_drive) as it:
+            for f in it:
+                m = self.ul_regex.match(f.name)
+                if not m or not f.is_file():
+                    continue
+                parts = self.ul_parts.setdefault((m.group(1).upper(), m.group(2)), {})
+                parts[int(m.group(3), 16)] = f.stat().st_size
+        return self.ul_parts
+
+    # ul.cfg entries & sizes of their parts
+    # Return: list of CatalogEntry
+    def scan_ul(self):
+        self.scan_ul_parts()
+        entries = []
+        filepath = os.path.join(self.opl_drive, "ul.cfg")
+        if not is_file(filepath):
+            return entries
+        ulcfg = ULConfig(filepath)
+        ulcfg.read()
+        for region_code, ulgame in ulcfg.ulgames.items():
+            title = ulgame.name.rstrip('\0')
+            opl_id = region_code.rstrip('\0')[3:]
+            crc32 = usba_crc32(title)
+            crc = "%08X" % crc32
+            parts = self.ul_parts.get((crc, opl_id), {})
+            filename = "ul.%s.%s" % (crc, opl_id)
+            entry = CatalogEntry(CatalogEntry.UL, region_code, opl_id, title, filename, \
+                    sum(parts.values()), 0, parts, crc32)
+            self.entries[region_code] = entry
+            entries.append(entry)
+        return entries
+
+    # Artwork types per OPL_ID in ART/
+    # Return: {OPL_ID: [type, ...]} (types upper case)
+    def scan_artwork(self):
+        art = {}
+        artdir = os.path.join(self.opl_drive, "ART")
+        if not is_dir(artdir):
+            return art
+        for f in os.listdir(artdir):
+            m = self.art_regex.match(f)
+            if m:
+                art.setdefault(to_opl_id(m.group(1)), []).append(m.group(2).upper())
+        return art
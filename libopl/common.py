@@ -4,7 +4,9 @@
 from os import path
 from pathlib import Path
 
+import os
 import ctypes
+import threading
 import configparser
 import unicodedata
 import re
@@ -22,31 +24,163 @@ def exists(filepath):
         return True
     return False
 
-def read_in_chunks(file_object, chunk_size=1024):
+# Default chunk size of read_in_chunks: 64k
+READ_CHUNK_SIZE = 64 * 1024
+
+def read_in_chunks(file_object, chunk_size=None):
     """Lazy function (generator) to read a file piece by piece.
-    Default chunk size: 1k."""
+    Default chunk size: IO.READ_CHUNK or 64k."""
+    if not chunk_size:
+        chunk_size = config("IO", "READ_CHUNK") or READ_CHUNK_SIZE
     while True:
         data = file_object.read(chunk_size)
         if not data:
             break
         yield data
 
-# Read configuration file
+# "8M" -> 8388608; suffixes K, M, G (powers of 1024), plain bytes otherwise
+def parse_size(value):
+    value = str(value).strip().upper().rstrip("B")
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
 ######
 # Configuration Class for libopl
-# Reads config file located at /home/$(whoami)/.config/opl.ini
+# Reads config file located at /home/$(whoami)/.config/opl.ini once
+# & re-reads it only when its mtime changes.
 #
-def config(section, key, filepath=str(Path.home())+"/.config/opl.ini"):
-    if is_file(filepath):
-        config = configparser.ConfigParser()
+# Every setting can be overridden, highest priority first:
+#  - set() / cli: --set SECTION.KEY=VALUE
+#  - environment: OPL_<SECTION>_<KEY>, e.g. OPL_API_CONCURRENCY=16
+#  - config file
+# Known settings are converted & validated, invalid values are ignored
+# (so the caller's default is used). Missing settings are None.
+class Config():
+    DEFAULT_PATH = str(Path.home()) + "/.config/opl.ini"
+
+    # (section, key): (type, min, max)
+    SETTINGS = {
+        ("API", "URL"): (str, None, None),
+        ("API", "STATIC_URL"): (str, None, None),
+        ("API", "BATCH_URL"): (str, None, None),
+        ("API", "CONCURRENCY"): (int, 1, 256),
+        ("API", "POOL_SIZE"): (int, 1, 256),
+        ("API", "TIMEOUT"): (float, 0.1, None),
+        ("API", "RETRIES"): (int, 0, 100),
+        ("DB", "PATH"): (str, None, None),
+        ("SEARCH", "PATH"): (str, None, None),
+        ("CACHE", "PATH"): (str, None, None),
+        ("CACHE", "MAX_SIZE"): (int, 0, None),
+        ("IO", "COPY_CHUNK"): (parse_size, 4096, 1 << 30),
+        ("IO", "READ_CHUNK"): (parse_size, 512, 1 << 30),
+        # OPL expects 1G parts, only change this for testing
+        ("UL", "CHUNK_SIZE"): (parse_size, 1 << 20, 1 << 30),
+        ("LIMITS", "READ"): (float, 0, None),
+        ("LIMITS", "WRITE"): (float, 0, None),
+        ("LIMITS", "HTTP"): (float, 0, None),
+    }
+
+    filepath = None
+
+    def __init__(self, filepath=None):
+        self.filepath = filepath if filepath else Config.DEFAULT_PATH
+        self.parser = None
+        self.mtime = None
+        self.overrides = {}
+        # Converted values: (section, key): value
+        self.values = {}
+        self.lock = threading.RLock()
+
+    def set_path(self, filepath):
+        with self.lock:
+            self.filepath = filepath
+            self.parser = None
+
+    # (Re-)read config file if it changed
+    def __load(self):
         try:
-            config.read(filepath)
-            return config[section][key]
-        except Exception as e:
-            print("Error: Couldn't read config file %s" % filepath)
-            print(e)
-            return None
-    return None
+            mtime = os.stat(self.filepath).st_mtime_ns
+        except OSError:
+            mtime = None
+        if self.parser is not None and mtime == self.mtime:
+            return
+        parser = configparser.ConfigParser()
+        if mtime is not None:
+            try:
+                parser.read(self.filepath)
+            except Exception as e:
+                print("Error: Couldn't read config file %s" % self.filepath)
+                print(e)
+        self.parser = parser
+        self.mtime = mtime
+        self.values = {}
+
+    # Convert & validate value of a known setting
+    # Raises ValueError
+    def __convert(self, section, key, value):
+        if (section, key) not in Config.SETTINGS:
+            return value
+        type, minimum, maximum = Config.SETTINGS[(section, key)]
+        value = type(value)
+        if minimum is not None and value < minimum:
+            raise ValueError("must be >= %s" % minimum)
+        if maximum is not None and value > maximum:
+            raise ValueError("must be <= %s" % maximum)
+        return value
+
+    # Override setting, e.g. from cli
+    # Return: False if value is invalid
+    def set(self, section, key, value):
+        section, key = section.upper(), key.upper()
+        try:
+            self.__convert(section, key, value)
+        except ValueError as e:
+            print("Error: Invalid value '%s' for %s.%s: %s" % (value, section, key, e))
+            return False
+        with self.lock:
+            self.overrides[(section, key)] = value
+            self.values.pop((section, key), None)
+        return True
+
+    # Raw string of setting, None if not set
+    def raw(self, section, key):
+        if (section, key) in self.overrides:
+            return self.overrides[(section, key)]
+        env = os.environ.get("OPL_%s_%s" % (section, key))
+        if env is not None:
+            return env
+        if self.parser.has_option(section, key):
+            return self.parser[section][key]
+        return None
+
+    def get(self, section, key):
+        section, key = section.upper(), key.upper()
+        with self.lock:
+            self.__load()
+            if (section, key) in self.values:
+                return self.values[(section, key)]
+            value = self.raw(section, key)
+            if value is not None and value != "":
+                try:
+                    value = self.__convert(section, key, value)
+                except ValueError as e:
+                    print("Error: Invalid value '%s' for %s.%s: %s" % (value, section, key, e))
+                    value = None
+            else:
+                value = None
+            self.values[(section, key)] = value
+            return value
+
+# Shared configuration
+settings = Config()
+
+# Read configuration value
+def config(section, key, filepath=None):
+    if filepath:
+        return Config(filepath).get(section, key)
+    return settings.get(section, key)
 
 
 """
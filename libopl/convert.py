@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+###
+# UL <-> ISO conversion
+#
+# UL -> ISO: parts are appended to the ISO one by one & deleted right after,
+#            so a conversion on the same drive needs about one part of
+#            free space instead of the whole image.
+# ISO -> UL: parts are cut off the end of the ISO, which is truncated
+#            after each part, same free space needs.
+#
+# Both directions can be resumed after an interruption by running them again.
+# The ul.cfg entry is added/removed atomically once all data is in place.
+# With "keep" the source stays untouched, e.g. to export a UL-Game as ISO.
+from libopl.common import is_file, usba_crc32, slugify
+from libopl.fileio import FileCopier
+from libopl.game import Game, ULGameImage
+from libopl.ul import ULConfig, ULConfigGame
+
+import os
+import re
+import json
+
+
+class ULConverter():
+    # media byte in ul.cfg
+    MEDIA_CD = 0x12
+    MEDIA_DVD = 0x14
+
+    opl_drive = None
+    copier = None
+    chunk_size = None
+    ulcfg = None
+
+    # ulcfg: use this (already read) ULConfig of opl_drive instead of reading it
+    def __init__(self, opl_drive, copier=None, chunk_size=None, ulcfg=None):
+        self.opl_drive = opl_drive
+        self.copier = copier if copier else FileCopier()
+        self.chunk_size = chunk_size if chunk_size else ULGameImage.get_chunk_size()
+        self.ulcfg = ulcfg
+
+    def __ulcfg(self):
+        if self.ulcfg:
+            return self.ulcfg
+        ulcfg = ULConfig(os.path.join(self.opl_drive, "ul.cfg"))
+        ulcfg.read()
+        return ulcfg
+
+    # Is filepath on opl_drive (same filesystem, below its path)?
+    # Only those ISOs may be consumed by an in-place conversion
+    def on_drive(self, filepath):
+        drive = os.path.realpath(self.opl_drive)
+        path = os.path.realpath(filepath)
+        if os.path.commonpath([drive, path]) != drive:
+            return False
+        try:
+            return os.stat(path).st_dev == os.stat(drive).st_dev
+        except OSError:
+            return False
+
+    def part_path(self, crc32, opl_id, part):
+        return os.path.join(self.opl_drive, "ul.%08X.%s.%02X" % (crc32, opl_id, part))
+
+    # Reassemble UL-Game opl_id into an ISO
+    # dest: target ISO path (Default: CD/ or DVD/ on opl_drive)
+    # keep: don't delete parts & ul.cfg entry
+    # Return: path to ISO or None
+    def ul_to_iso(self, opl_id, dest=None, keep=False):
+        ulcfg = self.__ulcfg()
+        ulgame = ulcfg.ulgames.get("ul." + opl_id)
+        if not ulgame:
+            print("Error: '%s' not found in ul.cfg" % opl_id)
+            return None
+
+        crc32 = usba_crc32(ulgame.name)
+        parts = ulgame.parts[0] if isinstance(ulgame.parts, bytes) else int(ulgame.parts)
+        media = ulgame.media[0] if isinstance(ulgame.media, bytes) else ulgame.media
+        if not dest:
+            folder = "CD" if media == ULConverter.MEDIA_CD else "DVD"
+            dest = os.path.join(self.opl_drive, folder, "%s.%s.iso" % (opl_id, slugify(ulgame.name)))
+        if is_file(dest):
+            print("Error: '%s' already exists!" % dest)
+            return None
+
+        # Offsets of the parts in the ISO are saved next to the temp file,
+        # so a resume uses the same layout
+        tmp = dest + ".part"
+        resume = is_file(tmp)
+        if resume:
+            print("Resuming conversion of '%s'..." % opl_id)
+            layout = self.__read_layout(tmp)
+        else:
+            layout = self.__layout(crc32, opl_id, parts)
+        if not layout:
+            return None
+        if len(layout["offsets"]) != parts:
+            print("Error: Layout of '%s' doesn't match ul.cfg (%d parts)!" % (tmp, parts))
+            return None
+        offsets = layout["offsets"]
+        sizes = [end - start for start, end in zip(offsets, offsets[1:] + [layout["size"]])]
+
+        # Parts are deleted in order after being copied, so only a leading run
+        # of them may be gone & the rest must still have their original size
+        copied = 0
+        while resume and not keep and copied < parts and \
+                not is_file(self.part_path(crc32, opl_id, copied)):
+            copied += 1
+        if resume and copied and os.path.getsize(tmp) < offsets[copied - 1] + sizes[copied - 1]:
+            print("Error: '%s' is incomplete, but parts are already deleted!" % tmp)
+            return None
+        for p in range(copied, parts):
+            filepath = self.part_path(crc32, opl_id, p)
+            if not is_file(filepath):
+                print("Error: Part %02X of '%s' is missing!" % (p, opl_id))
+                return None
+            if os.path.getsize(filepath) != sizes[p]:
+                print("Error: Part %02X of '%s' changed size since the conversion started!" % (p, opl_id))
+                return None
+        if not resume:
+            self.__write_layout(tmp, layout)
+
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            for p in range(copied, parts):
+                filepath = self.part_path(crc32, opl_id, p)
+                print("Copying part %02X..." % p)
+                self.copier.copy_into(filepath, fd, 0, offsets[p])
+                os.fsync(fd)
+                if not keep:
+                    os.remove(filepath)
+        finally:
+            os.close(fd)
+
+        os.replace(tmp, dest)
+        os.remove(tmp + ".layout")
+        if not keep:
+            ulcfg.remove_ulgame("ul." + opl_id)
+            ulcfg.write()
+        return dest
+
+    # Offsets from the actual part sizes, parts may have been written with
+    # another UL.CHUNK_SIZE than the current one
+    # Return: {"offsets": [...], "size": ISO size} or None
+    def __layout(self, crc32, opl_id, parts):
+        if not parts:
+            print("Error: '%s' has no parts in ul.cfg!" % opl_id)
+            return None
+        missing = [p for p in range(parts) if not is_file(self.part_path(crc32, opl_id, p))]
+        if missing:
+            print("Error: Part(s) %s of '%s' are missing!" \
+                    % (", ".join("%02X" % p for p in missing), opl_id))
+            return None
+        sizes = [os.path.getsize(self.part_path(crc32, opl_id, p)) for p in range(parts)]
+        # All parts but the last have the same size
+        odd = [p for p in range(parts - 1) if sizes[p] != sizes[0]]
+        if odd or sizes[-1] > sizes[0]:
+            print("Error: Part(s) %s of '%s' differ in size from part 00!" \
+                    % (", ".join("%02X" % p for p in odd or [parts - 1]), opl_id))
+            return None
+        offsets = [p * sizes[0] for p in range(parts)]
+        return {"offsets": offsets, "size": offsets[-1] + sizes[-1]}
+
+    def __write_layout(self, tmp, layout):
+        with open(tmp + ".layout.new", "w") as f:
+            json.dump(layout, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp + ".layout.new", tmp + ".layout")
+
+    def __read_layout(self, tmp):
+        try:
+            with open(tmp + ".layout", "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print("Error: Couldn't read layout of '%s', remove it to start over." % tmp)
+            print(e)
+            return None
+
+    # Split ISO into UL-Game on opl_drive
+    # title: UL-title (Default: title from filename), max. 32 chars
+    # keep: don't consume the ISO (needs space for the full image),
+    #       always the case for ISOs that aren't on opl_drive
+    # Return: ULConfigGame or None
+    def iso_to_ul(self, iso_path, title=None, keep=False):
+        if not keep and not self.on_drive(iso_path):
+            print("Info: '%s' isn't on opl_drive, copying instead of converting in place." % iso_path)
+            keep = True
+
+        filename = os.path.basename(iso_path)
+        ids = Game.id_regex.findall(filename)
+        if not ids:
+            print("Error: No OPL-ID found in '%s'" % filename)
+            return None
+        opl_id = Game(id=ids[0]).get("opl_id").upper()
+
+        if not title:
+            title = Game.id_regex.sub('', re.sub(r'\.[iI][sS][oO]$', '', filename)).strip('._-\\ ')
+        title = title[:32]
+        crc32 = usba_crc32(title)
+
+        ulcfg = self.__ulcfg()
+        if "ul." + opl_id in ulcfg.ulgames:
+            # Interrupted right before deleting the emptied ISO
+            if not keep and os.path.getsize(iso_path) == 0:
+                os.remove(iso_path)
+                return ulcfg.ulgames["ul." + opl_id]
+            print("Error: '%s' is already in ul.cfg" % opl_id)
+            return None
+
+        if keep:
+            parts = self.__split_copy(iso_path, crc32, opl_id)
+        else:
+            parts = self.__split_inplace(iso_path, crc32, opl_id)
+
+        game = Game()
+        game.set("title", title)
+        game.set("opl_id", opl_id)
+        game.set("parts", parts)
+        ulgame = ULConfigGame(game=game)
+        ulgame.media = bytes([ULConverter.MEDIA_CD if "/CD/" in "/" + iso_path.replace(os.sep, "/") \
+                else ULConverter.MEDIA_DVD])
+
+        ulcfg.add_ulgame(ulgame.region_code, ulgame)
+        ulcfg.write()
+        if not keep:
+            os.remove(iso_path)
+        return ulgame
+
+    # Forward copy, ISO stays untouched
+    def __split_copy(self, iso_path, crc32, opl_id):
+        size = os.path.getsize(iso_path)
+        parts = (size + self.chunk_size - 1) // self.chunk_size
+        for p in range(parts):
+            offset = p * self.chunk_size
+            print("Writing part %02X..." % p)
+            self.copier.copy(iso_path, self.part_path(crc32, opl_id, p), offset, \
+                    min(self.chunk_size, size - offset))
+        return parts
+
+    # Cut parts off the end of the ISO, truncating it after each one.
+    # Parts that exist beyond the (already truncated) ISO size are done.
+    def __split_inplace(self, iso_path, crc32, opl_id):
+        size = os.path.getsize(iso_path)
+        parts = (size + self.chunk_size - 1) // self.chunk_size
+        p = parts
+        while is_file(self.part_path(crc32, opl_id, p)):
+            p += 1
+        if p > parts:
+            print("Resuming conversion of '%s'..." % opl_id)
+            parts = p
+
+        for p in reversed(range(parts)):
+            offset = p * self.chunk_size
+            if offset >= size:
+                continue
+            print("Writing part %02X..." % p)
+            filepath = self.part_path(crc32, opl_id, p)
+            fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                self.copier.copy_into(iso_path, fd, offset, 0, size - offset)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.truncate(iso_path, offset)
+            size = offset
+        return parts
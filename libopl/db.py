@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+#####
+# Offline metadata database
+# Local SQLite store of game metadata (same JSON as returned by the API),
+# indexed on the normalized serial, e.g. "SLES-123.45" -> "SLES12345".
+#
+# Filled from a bulk JSON/CSV dump using "opl db import <dump>".
+# Config Example: https://github.com/Nold360/libopl/example.opl.ini
+from pathlib import Path
+from libopl.common import is_file, config
+
+import os
+import re
+import csv
+import json
+import sqlite3
+import hashlib
+
+
+# Strip everything but letters & digits from a serial/OPL-ID
+def normalize_serial(serial):
+    if not serial:
+        return None
+    return re.sub(r'[^A-Z0-9]', '', str(serial).upper())
+
+
+class MetadataDB():
+    DEFAULT_PATH = str(Path.home()) + "/.cache/libopl/metadata.db"
+
+    # Keys which may hold the serial of a game in a dump
+    ID_KEYS = ["id", "opl_id", "serial"]
+
+    filepath = None
+    conn = None
+
+    def __init__(self, filepath=None):
+        if not filepath:
+            filepath = config("DB", "PATH") or MetadataDB.DEFAULT_PATH
+        self.filepath = filepath
+
+        dirpath = os.path.dirname(self.filepath)
+        if dirpath and not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        self.conn = sqlite3.connect(self.filepath, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS games (
+                serial TEXT PRIMARY KEY,
+                hash TEXT NOT NULL,
+                data TEXT NOT NULL
+            ) WITHOUT ROWID""")
+        self.conn.commit()
+
+    # Open existing database, returns None if there is none (yet)
+    @staticmethod
+    def open(filepath=None):
+        if not filepath:
+            filepath = config("DB", "PATH") or MetadataDB.DEFAULT_PATH
+        if not is_file(filepath):
+            return None
+        try:
+            return MetadataDB(filepath)
+        except sqlite3.Error as e:
+            print("Error: Couldn't open metadata database %s" % filepath)
+            print(e)
+            return None
+
+    # Lookup metadata for serial / OPL-ID
+    # returns json-dict or None
+    def get(self, serial):
+        row = self.conn.execute("SELECT data FROM games WHERE serial = ?", \
+                (normalize_serial(serial),)).fetchone()
+        if not row:
+            return None
+        return json.loads(row[0])
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+
+    # Read games from a JSON or CSV dump
+    # JSON: list of games, {"games": [...]} or {"<serial>": {...}, ...}
+    # CSV:  header line, one game per row
+    def read_dump(self, filepath):
+        if re.match(r'.*\.csv$', filepath, re.IGNORECASE):
+            with open(filepath, newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    yield dict((k, self.__parse_csv_value(v)) for k, v in row.items() if k)
+            return
+
+        with open(filepath, encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data, dict) and isinstance(data.get("games"), list):
+            data = data["games"]
+        if isinstance(data, dict):
+            for serial, game in data.items():
+                if isinstance(game, dict):
+                    game.setdefault("id", serial)
+                    yield game
+        else:
+            for game in data:
+                if isinstance(game, dict):
+                    yield game
+
+    # Nested values (e.g. artwork) are stored as JSON in CSV dumps
+    def __parse_csv_value(self, value):
+        if value and value[0] in "[{":
+            try: return json.loads(value)
+            except ValueError: pass
+        return value
+
+    # Import/update games from dump
+    # Only rows whose content changed are written.
+    # Return: (inserted, updated, unchanged, skipped)
+    def import_dump(self, filepath):
+        inserted = updated = unchanged = skipped = 0
+        known = dict(self.conn.execute("SELECT serial, hash FROM games"))
+
+        rows = []
+        for game in self.read_dump(filepath):
+            serial = None
+            for key in MetadataDB.ID_KEYS:
+                serial = normalize_serial(game.get(key))
+                if serial: break
+            if not serial:
+                skipped += 1
+                continue
+
+            data = json.dumps(game, sort_keys=True, separators=(',', ':'))
+            digest = hashlib.sha1(data.encode('utf-8')).hexdigest()
+            if known.get(serial) == digest:
+                unchanged += 1
+                continue
+            if serial in known:
+                updated += 1
+            else:
+                inserted += 1
+            known[serial] = digest
+            rows.append((serial, digest, data))
+
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO games (serial, hash, data) " \
+                    "VALUES (?, ?, ?)", rows)
+        return (inserted, updated, unchanged, skipped)
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
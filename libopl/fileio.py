@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+###
+# File I/O helpers
+# OPL needs game files to be unfragmented on USB (FAT32) drives,
+# so everything written to an opl_drive goes through here.
+from libopl.common import is_file, config
+from libopl import throttle
+
+import os
+import fcntl
+import shutil
+import struct
+import ctypes
+import ctypes.util
+
+# FIEMAP ioctl (linux/fiemap.h)
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x00000001
+
+# struct fiemap header: fm_start, fm_length, fm_flags,
+# fm_mapped_extents, fm_extent_count, fm_reserved
+_fiemap = struct.Struct("=QQLLLL")
+
+# FICLONE ioctl (linux/fs.h), shares extents between files on btrfs/xfs/...
+FICLONE = 0x40049409
+
+# sync_file_range flags (linux/fs.h)
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# sync_file_range isn't exposed by the os module, get it from libc
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _sync_file_range = _libc.sync_file_range
+    _sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+except (OSError, AttributeError, TypeError):
+    _sync_file_range = None
+
+
+# Reserve "size" bytes for an open file descriptor in one go,
+# so the filesystem can hand out a single contiguous run of clusters.
+# Returns False if the filesystem can't preallocate.
+def preallocate(fd, size, offset=0):
+    if size <= 0:
+        return True
+    try:
+        os.posix_fallocate(fd, offset, size)
+    except (AttributeError, OSError):
+        return False
+    return True
+
+
+# Number of extents a file is made of, using the FIEMAP ioctl.
+# 1 extent = perfectly contiguous.
+# Returns None if the filesystem doesn't support FIEMAP.
+def count_extents(filepath):
+    if not is_file(filepath):
+        return None
+
+    buf = bytearray(_fiemap.pack(0, 0xFFFFFFFFFFFFFFFF, FIEMAP_FLAG_SYNC, 0, 0, 0))
+    try:
+        with open(filepath, 'rb') as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buf)
+    except OSError:
+        return None
+    return _fiemap.unpack(bytes(buf))[3]
+
+
+# Copy src to dst as reflink (copy-on-write clone) if the filesystem
+# supports it, falls back to a regular copy otherwise.
+# Return: True if reflinked
+def reflink(src, dst):
+    with open(src, 'rb') as infile, open(dst, 'wb') as outfile:
+        try:
+            fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            return True
+        except OSError:
+            shutil.copyfileobj(infile, outfile)
+    return False
+
+
+# Flush "length" bytes at "offset" of fd to disk and wait for it.
+# Falls back to fdatasync() where sync_file_range isn't available.
+def sync_range(fd, offset, length):
+    if _sync_file_range:
+        flags = SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER
+        if _sync_file_range(fd, offset, length, flags) == 0:
+            return
+    os.fdatasync(fd)
+
+
+# Start writeback of a range without waiting for it
+def start_writeback(fd, offset, length):
+    if _sync_file_range:
+        _sync_file_range(fd, offset, length, SYNC_FILE_RANGE_WRITE)
+
+
+# Tell the kernel we won't need that range in the page cache again
+def drop_cache(fd, offset, length):
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    except (AttributeError, OSError):
+        pass
+
+
+####
+# Copy engine used for adding games to an opl_drive
+#  - destination is preallocated at full size before writing
+#  - data is moved in large chunks
+#  - source & destination are dropped from the page cache as we go,
+#    so bulk ingests don't evict other hot data on the host
+#  - configurable sync policy to keep writeback smooth
+#  - reads & writes are throttled by the shared limiters in libopl.throttle
+class FileCopier():
+    # Size of a single read/write
+    CHUNK_SIZE = 8 * 1024 * 1024
+
+    # Sync policies
+    #  none:     leave it to the kernel
+    #  part:     fsync every file (ISO / UL-part) when it's done
+    #  interval: flush every "sync_interval" bytes using sync_file_range
+    #  end:      fsync all written files once in finish()
+    SYNC_NONE = "none"
+    SYNC_PART = "part"
+    SYNC_INTERVAL = "interval"
+    SYNC_END = "end"
+    SYNC_POLICIES = [SYNC_NONE, SYNC_PART, SYNC_INTERVAL, SYNC_END]
+
+    chunk_size = CHUNK_SIZE
+    sync = SYNC_INTERVAL
+    sync_interval = 64 * 1024 * 1024
+
+    # Files waiting for the final sync (SYNC_END)
+    pending = None
+
+    # RateLimiters for bytes read / written
+    read_limiter = None
+    write_limiter = None
+
+    def __init__(self, chunk_size=None, sync=None, sync_interval=None, \
+            read_limiter=None, write_limiter=None):
+        self.read_limiter = read_limiter if read_limiter else throttle.read
+        self.write_limiter = write_limiter if write_limiter else throttle.write
+        self.chunk_size = chunk_size or config("IO", "COPY_CHUNK") or FileCopier.CHUNK_SIZE
+        if sync:
+            if sync not in FileCopier.SYNC_POLICIES:
+                raise ValueError("Unknown sync policy '%s'" % sync)
+            self.sync = sync
+        if sync_interval:
+            self.sync_interval = sync_interval
+        self.pending = []
+
+    # Copy "length" bytes starting at "offset" of "src" into new file "dst"
+    # length=None copies until EOF
+    # Return: number of bytes written
+    def copy(self, src, dst, offset=0, length=None):
+        if length is None:
+            length = os.path.getsize(src) - offset
+
+        written = 0
+        infd = os.open(src, os.O_RDONLY)
+        try:
+            outfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                if not preallocate(outfd, length):
+                    print("Warn: Couldn't preallocate '%s', file may get fragmented." % dst)
+                try:
+                    os.posix_fadvise(infd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+                except (AttributeError, OSError):
+                    pass
+
+                written = self.__copy_fd(infd, outfd, offset, length)
+
+                # Source was shorter than expected, don't leave preallocated garbage
+                if written < length:
+                    os.ftruncate(outfd, written)
+
+                if self.sync == FileCopier.SYNC_PART:
+                    os.fsync(outfd)
+                elif self.sync == FileCopier.SYNC_INTERVAL:
+                    sync_range(outfd, 0, 0)
+                drop_cache(outfd, 0, 0)
+            finally:
+                os.close(outfd)
+        finally:
+            drop_cache(infd, offset, length)
+            os.close(infd)
+
+        if self.sync == FileCopier.SYNC_END:
+            self.pending.append(dst)
+        return written
+
+    # Copy loop on raw file descriptors
+    def __copy_fd(self, infd, outfd, offset, length):
+        written = 0
+        synced = 0
+        flushed = 0
+        os.lseek(infd, offset, os.SEEK_SET)
+        while written < length:
+            size = min(self.chunk_size, length - written)
+            self.read_limiter.consume(size)
+            chunk = os.read(infd, size)
+            if not chunk:
+                break
+            self.write_limiter.consume(len(chunk))
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(outfd, view):]
+
+            drop_cache(infd, offset + written, len(chunk))
+            written += len(chunk)
+
+            # Kick off writeback of the last window & wait for the one before,
+            # then the clean pages can be dropped from the page cache
+            if self.sync == FileCopier.SYNC_INTERVAL and written - synced >= self.sync_interval:
+                start_writeback(outfd, synced, written - synced)
+                if flushed < synced:
+                    sync_range(outfd, flushed, synced - flushed)
+                    drop_cache(outfd, flushed, synced - flushed)
+                    flushed = synced
+                synced = written
+        return written
+
+    # Copy "length" bytes of file "src" at "offset" into the open file
+    # descriptor "outfd" at "dst_offset", preallocating that range first.
+    # Uses copy_file_range(), so the kernel copies without going through
+    # userspace & filesystems like btrfs/xfs can share (reflink) the extents.
+    # Return: number of bytes copied
+    def copy_into(self, src, outfd, offset=0, dst_offset=0, length=None):
+        if length is None:
+            length = os.path.getsize(src) - offset
+        preallocate(outfd, length, dst_offset)
+
+        copied = 0
+        infd = os.open(src, os.O_RDONLY)
+        try:
+            while copied < length:
+                size = min(self.chunk_size, length - copied)
+                self.read_limiter.consume(size)
+                self.write_limiter.consume(size)
+                try:
+                    n = os.copy_file_range(infd, outfd, size, offset + copied, dst_offset + copied)
+                except (AttributeError, OSError):
+                    # Not supported (e.g. old kernel or cross-device), copy the hard way
+                    data = os.pread(infd, size, offset + copied)
+                    n = os.pwrite(outfd, data, dst_offset + copied) if data else 0
+                if n == 0:
+                    break
+                drop_cache(infd, offset + copied, n)
+                copied += n
+        finally:
+            os.close(infd)
+        return copied
+
+    # Sync everything that is still pending (SYNC_END)
+    def finish(self):
+        for filepath in self.pending:
+            try:
+                fd = os.open(filepath, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+                drop_cache(fd, 0, 0)
+            finally:
+                os.close(fd)
+        self.pending = []
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+###
+# Transactional Drive Fixing
+# Renames ISOs, UL-part sets & artwork to OPL's naming scheme:
+#   CD|DVD/{OPL_ID}.{title}.iso
+#   ul.{CRC32(title)}.{OPL_ID}.{PART} + matching name in ul.cfg
+#   ART/{OPL_ID}_{type}.{ext}
+#
+# The complete plan is computed first (one batched metadata lookup) &
+# journaled on the drive, then all renames are applied & ul.cfg is
+# replaced in one step. After an interruption the journal is used to
+# finish (resume) or undo (rollback) the plan.
+from libopl.common import is_file, slugify, usba_crc32
+from libopl.catalog import DriveCatalog, CatalogEntry, to_opl_id
+from libopl.ul import ULConfig
+
+import os
+import copy
+import json
+import base64
+
+
+class FixPlan():
+    JOURNAL = ".opl-fix.journal"
+
+    opl_drive = None
+    ulcfg = None
+
+    # ulcfg: already read ULConfig of opl_drive (Default: read it)
+    def __init__(self, opl_drive, ulcfg=None):
+        self.opl_drive = opl_drive
+        if not ulcfg:
+            ulcfg = ULConfig(os.path.join(opl_drive, "ul.cfg"))
+            ulcfg.read()
+        self.ulcfg = ulcfg
+        # [(src, dst)] relative to opl_drive
+        self.renames = []
+        # region_code: (old name, new name)
+        self.titles = {}
+        # ul.cfg before & after, None if unchanged
+        self.ulcfg_old = None
+        self.ulcfg_new = None
+
+    def journal_path(self):
+        return os.path.join(self.opl_drive, FixPlan.JOURNAL)
+
+    def __path(self, relpath):
+        return os.path.join(self.opl_drive, relpath)
+
+    # Compute the plan, metadata of all games is resolved at once
+    # api: API object or None to only normalize names
+    # Return: number of renames
+    def build(self, api=None):
+        catalog = DriveCatalog(self.opl_drive)
+        entries = catalog.scan()
+        isos = [e for e in entries.values() if e.type == CatalogEntry.ISO]
+        if api:
+            api.get_metadata_many([e.opl_id for e in isos if e.opl_id] + \
+                    [g.region_code[3:] for g in self.ulcfg.ulgames.values()])
+
+        planned = set()
+        def plan(src, dst):
+            if src == dst:
+                return
+            if dst in planned or (os.path.exists(self.__path(dst)) and \
+                    not os.path.samefile(self.__path(src), self.__path(dst))):
+                print("Warn: Skipping '%s', '%s' already exists!" % (src, dst))
+                return
+            planned.add(dst)
+            self.renames.append((src, dst))
+
+        # ISOs
+        for e in sorted(isos, key=lambda e: e.key):
+            if not e.opl_id:
+                print("Warn: No OPL-ID found in '%s', skipping..." % e.key)
+                continue
+            title = self.__title(api, e.opl_id, e.title)
+            filename = e.opl_id + ("." + title if title else "") + ".iso"
+            plan(e.key, os.path.dirname(e.key) + "/" + filename)
+
+        # UL-Games: new title means new CRC32, so all parts get renamed
+        ulgames = {}
+        for region_code, ulgame in self.ulcfg.ulgames.items():
+            opl_id = region_code[3:]
+            title = self.__title(api, opl_id, ulgame.name)[:32]
+            if title == ulgame.name:
+                continue
+            old_crc = "%08X" % int(ulgame.crc32, 16)
+            new_crc = "%08X" % usba_crc32(title)
+            parts = catalog.ul_parts.get((old_crc, opl_id), {})
+            if not parts:
+                print("Warn: No parts found for UL-Game '%s', skipping..." % opl_id)
+                continue
+            count = len(self.renames)
+            for p in sorted(parts):
+                plan("ul.%s.%s.%02X" % (old_crc, opl_id, p), "ul.%s.%s.%02X" % (new_crc, opl_id, p))
+            if len(self.renames) - count != len(parts):
+                # Part set must be renamed completely or not at all
+                del self.renames[count:]
+                continue
+            self.titles[region_code] = (ulgame.name, title)
+            game = copy.copy(ulgame)
+            game.name = title
+            ulgames[region_code] = game
+
+        if self.titles:
+            self.ulcfg_old = self.__ulcfg_bytes(self.ulcfg.ulgames)
+            self.ulcfg_new = self.__ulcfg_bytes(dict(self.ulcfg.ulgames, **ulgames))
+
+        # Artwork, normalize OPL-ID
+        artdir = self.__path("ART")
+        if os.path.isdir(artdir):
+            for f in sorted(os.listdir(artdir)):
+                m = DriveCatalog.art_regex.match(f)
+                if not m:
+                    continue
+                filename = "%s_%s.%s" % (to_opl_id(m.group(1)), m.group(2), m.group(3))
+                plan("ART/" + f, "ART/" + filename)
+
+        # Renaming a file onto another one's old name would need an order, skip those
+        sources = set(s for s, d in self.renames)
+        for src, dst in list(self.renames):
+            if dst in sources:
+                print("Warn: Skipping '%s', '%s' is renamed too!" % (src, dst))
+                self.renames.remove((src, dst))
+        return len(self.renames)
+
+    # Title from metadata, else the current one
+    def __title(self, api, opl_id, title):
+        meta = api.lookup_metadata(opl_id) if api else None
+        if meta and meta.get("name"):
+            return slugify(meta["name"][:32])
+        return title
+
+    def __ulcfg_bytes(self, ulgames):
+        return b"".join(g.get_binary_data() for g in ulgames.values())
+
+    def dump(self):
+        for src, dst in self.renames:
+            print(" %s -> %s" % (src, dst))
+        for region_code, (old, new) in self.titles.items():
+            print(" ul.cfg [%s] '%s' -> '%s'" % (region_code[3:], old, new))
+
+    # Write journal atomically
+    def __write_journal(self, state):
+        data = {
+            "state": state,
+            "renames": self.renames,
+            "titles": self.titles,
+            "ulcfg_old": base64.b64encode(self.ulcfg_old).decode() if self.ulcfg_old else None,
+            "ulcfg_new": base64.b64encode(self.ulcfg_new).decode() if self.ulcfg_new else None,
+        }
+        tmp = self.journal_path() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_path())
+        self.__sync_dir(self.opl_drive)
+
+    # Load unfinished plan from opl_drive's journal
+    # Return: FixPlan or None
+    @staticmethod
+    def load(opl_drive, ulcfg=None):
+        filepath = os.path.join(opl_drive, FixPlan.JOURNAL)
+        if not is_file(filepath):
+            return None
+        try:
+            with open(filepath, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print("Error: Couldn't read journal '%s'" % filepath)
+            print(e)
+            return None
+        plan = FixPlan(opl_drive, ulcfg)
+        plan.renames = [tuple(r) for r in data["renames"]]
+        plan.titles = dict((k, tuple(v)) for k, v in data["titles"].items())
+        if data.get("ulcfg_old") is not None:
+            plan.ulcfg_old = base64.b64decode(data["ulcfg_old"])
+            plan.ulcfg_new = base64.b64decode(data["ulcfg_new"])
+        return plan
+
+    def __sync_dir(self, dirpath):
+        try:
+            fd = os.open(dirpath, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    # Exact name in directory? (FAT/exFAT are case-insensitive)
+    def __present(self, relpath, listings):
+        dirpath = os.path.dirname(self.__path(relpath))
+        if dirpath not in listings:
+            listings[dirpath] = set(os.listdir(dirpath)) if os.path.isdir(dirpath) else set()
+        return os.path.basename(relpath) in listings[dirpath]
+
+    def __rename(self, src, dst, listings):
+        os.rename(self.__path(src), self.__path(dst))
+        listings[os.path.dirname(self.__path(src))].discard(os.path.basename(src))
+        listings.setdefault(os.path.dirname(self.__path(dst)), set()).add(os.path.basename(dst))
+
+    # Replace ul.cfg with "data" & keep the shared ULConfig in sync
+    def __write_ulcfg(self, data, names):
+        tmp = os.path.join(self.opl_drive, "ul.cfg.new")
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.opl_drive, "ul.cfg"))
+        self.__sync_dir(self.opl_drive)
+        for region_code, name in names.items():
+            ulgame = self.ulcfg.ulgames.get(region_code)
+            if ulgame:
+                ulgame.name = name
+                ulgame.crc32 = hex(usba_crc32(name))
+
+    # Apply (or resume) the plan
+    # Return: True on success, False after rolling back
+    def apply(self):
+        if not self.renames and not self.ulcfg_new:
+            return True
+        if not is_file(self.journal_path()):
+            self.__write_journal("applying")
+
+        listings = {}
+        for src, dst in self.renames:
+            src_there = self.__present(src, listings)
+            dst_there = self.__present(dst, listings)
+            if src_there and not dst_there:
+                print("Renaming: %s -> %s" % (src, dst))
+                try:
+                    self.__rename(src, dst, listings)
+                except OSError as e:
+                    print("Error: Couldn't rename '%s':" % src)
+                    print(e)
+                    self.rollback()
+                    return False
+            elif not dst_there:
+                print("Error: '%s' disappeared, rolling back..." % src)
+                self.rollback()
+                return False
+        for dirpath in listings:
+            self.__sync_dir(dirpath)
+
+        if self.ulcfg_new:
+            print("Writing ul.cfg...")
+            self.__write_ulcfg(self.ulcfg_new, dict((k, v[1]) for k, v in self.titles.items()))
+
+        os.remove(self.journal_path())
+        return True
+
+    # Undo everything that was applied
+    def rollback(self):
+        listings = {}
+        for src, dst in reversed(self.renames):
+            if self.__present(dst, listings) and not self.__present(src, listings):
+                print("Restoring: %s -> %s" % (dst, src))
+                self.__rename(dst, src, listings)
+        for dirpath in listings:
+            self.__sync_dir(dirpath)
+
+        if self.ulcfg_old:
+            print("Restoring ul.cfg...")
+            self.__write_ulcfg(self.ulcfg_old, dict((k, v[0]) for k, v in self.titles.items()))
+
+        if is_file(self.journal_path()):
+            os.remove(self.journal_path())
+        return True
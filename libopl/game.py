@@ -2,7 +2,8 @@
 ###
 # Game Class
 # 
-from libopl.common import usba_crc32, slugify, is_file, read_in_chunks
+from libopl.common import usba_crc32, slugify, is_file, read_in_chunks, config
+from libopl.fileio import FileCopier
 from os import path
 
 import re
@@ -39,6 +40,8 @@ class Game():
 
     # Recover generate id from filename
     def __init__(self, filepath=None, id=None, recover_id=True):
+        # Own copy of the data-dict per game, so many games can be kept around
+        self.data = dict(Game.data)
         if filepath:
             self.set("filepath", filepath)
             self.get_common_filedata(recover_id)
@@ -185,6 +188,11 @@ class ULGameImage(Game):
     # Chunk size matched USBUtil
     CHUNK_SIZE = 1073741824
 
+    # Part size, UL.CHUNK_SIZE or CHUNK_SIZE
+    @staticmethod
+    def get_chunk_size():
+        return config("UL", "CHUNK_SIZE") or ULGameImage.CHUNK_SIZE
+
     # Generate ULGameImage from filepath, ulcfg, or raw (meta-)data
     def __init__(self, filepath=None, ulcfg=None, data=None):
         # From file
@@ -193,12 +201,13 @@ class ULGameImage(Game):
             self.get_filedata()
         # FRom ul.cfg
         elif ulcfg:
+            super().__init__()
             self.ulcfg = ulcfg
             self.set("opl_id", self.ulcfg.region_code.replace('ul.', ''))
             self.set("id", self.get("opl_id"))
             self.set("title", self.ulcfg.name)
             self.set("crc32", self.ulcfg.crc32)
-            self.set("filename", "ul." + self.get("crc32").replace('0x', '').upper())
+            self.set("filename", "ul.%08X" % int(self.get("crc32"), 16))
             self.set("filename", self.get("filename") + "." + self.get("opl_id") + ".00")
         # Evolved from Game-Class
         elif data:
@@ -221,24 +230,31 @@ class ULGameImage(Game):
         return True
 
     # (Split) ISO into UL-Format
-    def to_UL(self, dest_path, force=False):
+    # Every part is preallocated at full size before writing,
+    # so it ends up contiguous on the opl_drive
+    def to_UL(self, dest_path, force=False, copier=None):
+        if not copier:
+            copier = FileCopier()
+
         file_part = 0
-        with open(self.get("filepath"), 'rb') as f:
-            chunk = f.read(ULGameImage.CHUNK_SIZE)
-            while chunk:
-                filename =  'ul.%s.%s.%.2X' % ( self.get("crc32")[2:].upper(), \
-                            self.get("opl_id"), file_part)
-                filepath = path.join(dest_path, filename)
-
-                if is_file(filepath) and not force:
-                    print("Warn: File '%s' already exists! Use -f to force overwrite." % filename)
-                    return 0
-
-                print("Writing File '%s'..." % filepath)
-                with open(filepath, 'wb') as outfile:
-                    outfile.write(chunk)
-                    file_part += 1 
-                    chunk = f.read(ULGameImage.CHUNK_SIZE)
+        chunk_size = ULGameImage.get_chunk_size()
+        size = path.getsize(self.get("filepath"))
+        offset = 0
+        while offset < size:
+            # OPL expects the CRC32 as 8 hex digits, zero-padded
+            filename =  'ul.%08X.%s.%.2X' % ( int(self.get("crc32"), 16), \
+                        self.get("opl_id"), file_part)
+            filepath = path.join(dest_path, filename)
+
+            if is_file(filepath) and not force:
+                print("Warn: File '%s' already exists! Use -f to force overwrite." % filename)
+                return 0
+
+            print("Writing File '%s'..." % filepath)
+            length = min(chunk_size, size - offset)
+            copier.copy(self.get("filepath"), filepath, offset, length)
+            offset += length
+            file_part += 1
         self.set("parts", file_part)
         return file_part
 
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+#####
+# HTTP Request Layer
+# Makes API requests robust against a flaky/overloaded server:
+#  - connect/read timeouts
+#  - retries with jittered exponential backoff on errors, 5xx & 429,
+#    honoring the Retry-After header
+#  - AIMD concurrency limit: grows slowly while responses are fast & fine,
+#    halves when latency or errors rise
+#  - circuit breaker: after repeated failures requests fail fast for a while,
+#    callers fall back to cached data only
+#
+# Works with any requests.Session, point the API at a local stub server to test.
+from email.utils import parsedate_to_datetime
+
+import time
+import random
+import datetime
+import threading
+import requests
+
+
+# Raised instead of sending requests while the circuit is open
+class APIUnavailable(Exception):
+    pass
+
+
+####
+# Additive increase / multiplicative decrease concurrency limit
+class AIMDLimiter():
+    min_limit = 1
+    max_limit = None
+
+    # Responses slower than this count as congestion
+    latency_target = None
+
+    def __init__(self, max_limit=8, min_limit=1, latency_target=2.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_target = latency_target
+        self.limit = float(max_limit)
+        self.inflight = 0
+        self.last_decrease = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+
+    # Release slot & adapt limit to outcome of the request
+    def release(self, ok=True, latency=0):
+        with self.cond:
+            self.inflight -= 1
+            if ok and latency <= self.latency_target:
+                # +1 per "limit" successful requests, ~ +1 per round trip
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            elif time.monotonic() - self.last_decrease > max(latency, 1.0):
+                # Only decrease once per round trip
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.last_decrease = time.monotonic()
+            self.cond.notify_all()
+
+
+####
+# closed: requests pass, consecutive failures are counted
+# open: requests fail fast with APIUnavailable for "reset_timeout" seconds
+# half-open: one trial request, success closes the circuit again
+class CircuitBreaker():
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    # May a request be sent?
+    def allow(self):
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and \
+                    time.monotonic() - self.opened >= self.reset_timeout:
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    print("Warn: API seems to be down, using cached data only for %ds." \
+                            % self.reset_timeout)
+                self.state = CircuitBreaker.OPEN
+                self.opened = time.monotonic()
+
+    def is_open(self):
+        return self.state == CircuitBreaker.OPEN
+
+
+class HTTPClient():
+    # Status codes worth retrying
+    RETRY_STATUS = [429, 500, 502, 503, 504]
+
+    # (connect, read) timeout in seconds
+    timeout = (5, 30)
+    retries = 3
+
+    # Backoff: random(0, min(max, base * 2^attempt)) seconds
+    backoff_base = 0.5
+    backoff_max = 30
+
+    session = None
+    limiter = None
+    concurrency = None
+    breaker = None
+
+    def __init__(self, session=None, limiter=None, concurrency=None, breaker=None, \
+            timeout=None, retries=None):
+        self.session = session if session else requests.Session()
+        # Optional RateLimiter (requests/s), see libopl.throttle
+        self.limiter = limiter
+        self.concurrency = concurrency if concurrency else AIMDLimiter()
+        self.breaker = breaker if breaker else CircuitBreaker()
+        if timeout:
+            self.timeout = timeout
+        if retries is not None:
+            self.retries = retries
+
+    # Seconds to wait before next attempt
+    def backoff(self, attempt, response=None):
+        if response is not None and response.headers.get("Retry-After"):
+            retry_after = response.headers.get("Retry-After")
+            try:
+                return min(self.backoff_max, max(0, float(retry_after)))
+            except ValueError:
+                pass
+            try:
+                date = parsedate_to_datetime(retry_after)
+                delay = (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                return min(self.backoff_max, max(0, delay))
+            except (TypeError, ValueError):
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    # Send request, retrying on errors
+    # Return: requests.Response (may still be a 4xx/5xx after all retries)
+    # Raises: APIUnavailable if the circuit is open, last exception on network errors
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise APIUnavailable("API unavailable, circuit open")
+            if self.limiter:
+                self.limiter.consume()
+
+            response = None
+            error = None
+            self.concurrency.acquire()
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            except Exception:
+                self.concurrency.release(False, time.monotonic() - start)
+                raise
+            failed = error is not None or response.status_code in HTTPClient.RETRY_STATUS
+            self.concurrency.release(not failed, time.monotonic() - start)
+
+            if not failed:
+                self.breaker.success()
+                return response
+
+            self.breaker.failure()
+            if attempt >= self.retries:
+                if error is not None:
+                    raise error
+                return response
+
+            time.sleep(self.backoff(attempt, response))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
@@ -2,21 +2,34 @@
 ###
 # Python CLI Replacement for OPLManager
 # 
-from shutil import move, copyfile
 from zlib import crc32
 
 from libopl.artwork import Artwork
 from libopl.api import API
-from libopl.common import is_file, is_dir, exists
+from libopl.common import is_file, is_dir, exists, config, settings
+from libopl.db import MetadataDB
+from libopl.search import SearchIndex
+from libopl.catalog import DriveCatalog
+from libopl.verify import ULVerifier
+from libopl.convert import ULConverter
+from libopl.fileio import FileCopier, count_extents
+from libopl.watch import DropFolderWatcher
+from libopl.vmc import VMCImage, assign_vmc
+from libopl.batch import BatchRunner
+from libopl.fix import FixPlan
+from libopl.snapshot import Snapshot, SnapshotWriter, diff_snapshots, diff_live
 from libopl.game import Game, ULGameImage, IsoGameImage
+from libopl import throttle
 from libopl.ul import ULConfig, ULConfigGame
 
 import os
 import re
 import sys
 import json
+import time
 import argparse
 import requests
+import threading
 
 ## todo
 # config file ~/.config/popl.yml
@@ -30,6 +43,11 @@ class POPLManager:
 
     def __init__(self, args=None):
         self.set_args(args)
+        self.ulcfg_lock = threading.RLock()
+        # Batch mode: shared ul.cfg handles & directory listings per drive
+        self.ulcfgs = None
+        self.dirty = set()
+        self.listings = None
 
     def set_args(self, args):
         self.args = args
@@ -37,6 +55,8 @@ class POPLManager:
     # Return: array of filepath's for all games on opl_drive
     def __get_opl_games(self, opl_drive, type="DVD"):
         path = os.path.join(opl_drive, type)
+        if self.listings is not None and path in self.listings:
+            return list(self.listings[path])
         games = []
         for f in os.listdir(path): 
             filepath = os.path.join(path, f)
@@ -45,10 +65,65 @@ class POPLManager:
             if re.match(r'^ul\..*\.[0-9][1-9]$', f): continue
             if is_file(filepath):
                 games.append(filepath)
+        if self.listings is not None:
+            self.listings[path] = list(games)
         return games
 
+    # Batch mode: ul.cfg of every drive is read once, shared by all
+    # operations & written once by end_batch()
+    def begin_batch(self):
+        self.ulcfgs = {}
+        self.dirty = set()
+        self.listings = {}
+
+    # Write all changed ul.cfg's & leave batch mode
+    # Return: list of drives whose ul.cfg was written
+    def end_batch(self):
+        written = []
+        with self.ulcfg_lock:
+            for key in sorted(self.dirty):
+                print("Writing %s..." % self.ulcfgs[key].filepath)
+                self.ulcfgs[key].write()
+                written.append(key)
+            self.ulcfgs = None
+            self.dirty = set()
+            self.listings = None
+        return written
+
+    # Drop cached directory listings of opl_drive after changing it
+    def invalidate(self, opl_drive):
+        if self.listings is None:
+            return
+        for type in ['CD', 'DVD']:
+            self.listings.pop(os.path.join(opl_drive, type), None)
+
+    # Return: ULConfig of opl_drive, shared in batch mode
+    def get_ulcfg(self, opl_drive):
+        filepath = os.path.join(opl_drive, "ul.cfg")
+        with self.ulcfg_lock:
+            if self.ulcfgs is None:
+                ulcfg = ULConfig(filepath)
+                ulcfg.read()
+                return ulcfg
+            key = os.path.realpath(opl_drive)
+            if key not in self.ulcfgs:
+                ulcfg = ULConfig(filepath)
+                ulcfg.read()
+                self.ulcfgs[key] = ulcfg
+            return self.ulcfgs[key]
+
+    # Write ul.cfg of opl_drive, deferred to end_batch() in batch mode
+    def commit_ulcfg(self, opl_drive, ulcfg):
+        with self.ulcfg_lock:
+            if self.ulcfgs is None:
+                ulcfg.write()
+            else:
+                self.dirty.add(os.path.realpath(opl_drive))
+
     # Generate Game-object for every path in "source"-list
-    def __get_games(self, source):
+    # Metadata of all games is resolved at once (parallel requests)
+    def __get_games(self, source, metadata=True):
+        games = []
         for filepath in source:
             if re.match(r'.*/ul\..*0$', filepath):
                 game = ULGameImage(filepath)
@@ -57,19 +132,23 @@ class POPLManager:
             else:
                 print("ERROR: Couldn't determine filetype from '%s'" % filepath)
                 continue
+            games.append(game)
 
-            game.set_metadata(self.api)
-            yield game
+        if metadata and self.api:
+            self.api.get_metadata_many([g.get("id") for g in games])
+            for game in games:
+                game.set_metadata(self.api)
+        return games
 
     # Download artwork CLI, duh
     # For every game in args.opl_drive
     def download_artwork(self, args):
         print("Searching Artwork...")
         if not self.api:
-            self.api = API()
-        self.__get_games(self.__get_opl_games(args.opl_drive))
+            self.api = API(transcode=args.resize)
+        games = self.__get_games(self.__get_opl_games(args.opl_drive))
         
-        for game in self.games:
+        for game in games:
             if game.type != Game.UL:
                 if not game.get("meta"):
                     meta = self.api.get_metadata(game.get("id"))
@@ -78,10 +157,10 @@ class POPLManager:
                 self.api.download_artwork(game, args.opl_drive, override=args.force)
 
         print("\nReading ul.cfg...")
-        if is_file(args.opl_drive + "/ul.cfg"):
-            ulcfg = ULConfig(os.path.join(args.opl_drive, "ul.cfg"))
-            ulcfg.read()
+        ulcfg = self.get_ulcfg(args.opl_drive)
+        if ulcfg.ulgames:
             ulcfg.dump()
+            self.api.get_metadata_many([u[3:] for u in ulcfg.ulgames])
             for ulgame in ulcfg.ulgames:
                 game=ULGameImage(ulcfg=ulcfg.ulgames[ulgame])
                 game.set("meta", self.api.get_metadata(game.get("opl_id")))
@@ -89,22 +168,43 @@ class POPLManager:
                 game.dump()
                 self.api.download_artwork(game, args.opl_drive, override=args.force)
         else:
-            print("Skipped. No ul.cfg found on opl_drive.")
+            print("Skipped. No UL-Games found on opl_drive.")
         return True
 
+    # Delete game(s) args.opl_id from args.opl_drive:
+    #  ISOs in CD/ & DVD/, UL-Games' part files & ul.cfg entry
+    # Return: True if every game was found & deleted
     def delete(self, args):
-        self.__get_games(self.__get_opl_games(args.opl_drive))
-        for game in self.games:
-            if game.type != Game.UL:
-                print(game.get('opl_id'))
-
-        print("\nReading ul.cfg...")
-        if is_file(args.opl_drive + "/ul.cfg"):
-            ulcfg = ULConfig(os.path.join(args.opl_drive, "ul.cfg"))
-            ulcfg.read()
-            for ulgame in ulcfg.ulgames:
-                game=ULGameImage(ulcfg=ulcfg.ulgames[ulgame])
-                print(game.get('opl_id'))
+        catalog = DriveCatalog(args.opl_drive)
+        entries = catalog.scan()
+        ok = True
+        for opl_id in args.opl_id:
+            opl_id = opl_id.upper()
+            found = False
+            for entry in entries.values():
+                if entry.type == "iso" and entry.opl_id == opl_id:
+                    print("Deleting %s..." % entry.key)
+                    os.remove(os.path.join(args.opl_drive, entry.key))
+                    found = True
+
+            with self.ulcfg_lock:
+                ulcfg = self.get_ulcfg(args.opl_drive)
+                ulgame = ulcfg.ulgames.get("ul." + opl_id)
+                if ulgame:
+                    crc = "%08X" % int(ulgame.crc32, 16)
+                    for part in sorted(catalog.ul_parts.get((crc, opl_id), {})):
+                        filename = "ul.%s.%s.%02X" % (crc, opl_id, part)
+                        print("Deleting %s..." % filename)
+                        os.remove(os.path.join(args.opl_drive, filename))
+                    print("Removing '%s' from ul.cfg..." % ulgame.name)
+                    ulcfg.remove_ulgame("ul." + opl_id)
+                    self.commit_ulcfg(args.opl_drive, ulcfg)
+                    found = True
+
+            if not found:
+                print("Error: Game '%s' not found on opl_drive!" % opl_id)
+                ok = False
+        return ok
 
     # Add game(s) to args.opl_drive
     #  - split game if > 4GB / forced
@@ -112,13 +212,22 @@ class POPLManager:
     #  - download metadata from api
     #  - rename game to title from api (if enabled)
     #  - download artwork
+    #  - largest images are written first, so the big files
+    #    get the big contiguous runs of free space
+    # Return: True if all games were added
     def add(self, args):
-        self.api = API()
-        
-        
-        for game in self.__get_games(args.src_file):
+        if not self.api:
+            self.api = API(transcode=args.resize)
+        elif args.resize and not self.api.transcoder:
+            self.api.enable_transcoding()
+        copier = FileCopier(sync=args.sync, sync_interval=args.sync_interval << 20)
+        failed = 0
+
+        src_files = sorted(args.src_file, key=lambda f: os.path.getsize(f) if is_file(f) else 0, reverse=True)
+        for game in self.__get_games(src_files):
             if not game.get('id'):
                 print("Error while parsing file: %s" % game.get("filepath"))
+                failed += 1
                 continue
 
             if game.get("size") > 4000 or args.ul:
@@ -132,22 +241,23 @@ class POPLManager:
             if game.type == Game.UL:
                 print("Adding file in UL-Format...")
 
-                fileparts = game.to_UL(args.opl_drive, args.force)
+                fileparts = game.to_UL(args.opl_drive, args.force, copier)
                 if fileparts == 0:
                    print("Something went wrong, skipping game '%s'!" % game.get('filename'))
+                   failed += 1
                    continue
  
                 # Create OPL-Config for Game; read & merge ul.cfg
+                # (locked, games may be added by several workers at once)
                 game.ulcfg = ULConfigGame(game=game)
-                cfg = ULConfig(os.path.join(args.opl_drive, "ul.cfg"), \
-                        {game.get("opl_id"): game.ulcfg})
-
-                print("Reading ul.cfg...")
-                cfg.read()
-                cfg.dump()
+                with self.ulcfg_lock:
+                    print("Reading ul.cfg...")
+                    cfg = self.get_ulcfg(args.opl_drive)
+                    cfg.add_ulgame(game.ulcfg.region_code, game.ulcfg)
+                    cfg.dump()
 
-                print("Writing ul.cfg...")
-                cfg.write()
+                    print("Writing ul.cfg...")
+                    self.commit_ulcfg(args.opl_drive, cfg)
 
                 print("Done! - Happy Gaming! :)")
 
@@ -165,16 +275,22 @@ class POPLManager:
                 if is_file(filepath) and not args.force:
                     print("Warn: File '%s' already exists! Use -f to force overwriting." % game.get('filename'))
                     print('Skipping game...')
+                    failed += 1
                     continue
                 elif args.force:
                     print("Overwriting forced!")
 
-                copyfile(game.get("filepath"), filepath)
+                copier.copy(game.get("filepath"), filepath)
  
             
             # Finally download artwork
             print("Downloading Artwork...")
             self.api.download_artwork(game, args.opl_drive)
+
+        if copier.pending:
+            print("Syncing files to opl_drive...")
+        copier.finish()
+        return failed == 0
                 
     def __get_data_from_api(self, title_id):
         if not self.api:
@@ -183,64 +299,44 @@ class POPLManager:
 
     # Try fixing a OPL-Drive by:
     #  - Rename ISOs to {OPL-ID}.{title}.iso
-    #  - Download missing artwork / overwrite existing
+    #  - Rename UL-Games to their title from API (parts & ul.cfg)
+    #  - Normalize OPL-ID of artwork files
+    # All renames are planned & journaled first, see libopl.fix
     def fix(self, args):
-        self.api = API()
-        self.__get_games(self.__get_opl_games(args.opl_drive))
-        
-        # FIXME: No merge, full overwrite..?
-        self.ulcfg = ULConfig(os.path.join(args.opl_drive, "ul.cfg"))
-        self.ulcfg.read()
-
-        for game in self.games:
-            if not game.get('id'):
-                print("Error while parsing file: %s" % game.get("filepath"))
-                continue
-
-            print("Fixing '%s'..." % game.get("filename"))
-
-            if not game.get("id"):
-                print("ID not found in file: '%s'" % game.get("filepath"))
-                continue
-
-
-            # Always use API to fix game names
-            if not game.set_metadata(self.api, True):
-                print("WARN: Couldn't get Metadata from API for '%s'" % game.filepath)
-
-            # Generate OPL-ID & try evolving game-object to child class
-            #game.gen_opl_id()
-            tmp = game.evolve()
-            if tmp:
-                game = tmp
-            game.dump()
-
-            # Change filename?
-            if not game.get("new_filename"):
-                filename = game.get("filename")
+        ulcfg = self.get_ulcfg(args.opl_drive)
+        journal = FixPlan.load(args.opl_drive, ulcfg)
+        if args.rollback or args.resume:
+            if not journal:
+                print("Nothing to do, no unfinished fix found on %s." % args.opl_drive)
+                return True
+            if args.rollback:
+                print("Rolling back unfinished fix...")
+                ok = journal.rollback()
             else:
-                filename = game.get("new_filename")
-
-            if isinstance(game, ULGameImage):
-                # TODO: 
-                #  - Search ul-games on disk
-                #  - read ul.cfg
-                #  - check existance of images, in ul.cfg
-                #  - write fixed ul.cfg
-                game.ulcfg = ULConfigGame(game=game) 
-                cfg = (args.opl_drive+"/ul.cfg", {game.get("opl_id"): game.ulcfg})
-
-                #will override cfg for now if fixing stuff...
-           
-            # Game already in correct format?
-            if game.get("filename") == filename:
-                print("Nothing to do...")
-                continue
+                print("Resuming unfinished fix...")
+                ok = journal.apply()
+            self.invalidate(args.opl_drive)
+            return ok
+        if journal:
+            print("Error: Found unfinished fix on %s, use --resume or --rollback!" % args.opl_drive)
+            return False
 
-            # Move stuff
-            print("Renaming: %s -> %s" %(game.get("filename"), filename))
-            destfilepath=os.path.join(args.opl_drive, "DVD", filename + "." + game.get("filetype"))
-            move(game.get("filepath"), destfilepath)
+        if not self.api:
+            self.api = API()
+        plan = FixPlan(args.opl_drive, ulcfg)
+        print("Planning renames...")
+        if not plan.build(self.api):
+            print("Nothing to do...")
+            return True
+        plan.dump()
+        if args.dry_run:
+            return True
+
+        ok = plan.apply()
+        self.invalidate(args.opl_drive)
+        if ok:
+            print("Done! Renamed %d file(s)." % len(plan.renames))
+        return ok
 
     # List all Games on OPL-Drive
     def list(self, args):
@@ -248,15 +344,21 @@ class POPLManager:
         print("|-> ISO-Games:")
 
         # Find all game iso's
+        games = []
         for media_file in self.__get_opl_games(args.opl_drive, type="DVD"):
             game = Game(media_file)
             game = game.evolve()
             game.get_filedata()
 #            game.gen_opl_id()
+            games.append(game)
+
+        if args.online:
+            self.api = API()
+            self.api.get_metadata_many([g.get("id") for g in games])
 
+        for game in games:
             if args.online:
-                api = API()
-                game.set_metadata(api, args.rename)
+                game.set_metadata(self.api)
             
             if isinstance(game, IsoGameImage):
                 print(" [%s] %s " %(game.get("opl_id"), game.get("title")))
@@ -270,6 +372,353 @@ class POPLManager:
                 print(" [%s] %s" % (game.replace('ul.', ''), ulcfg.ulgames[game].name))
 
     
+    # Warm the shared artwork cache for a list of OPL-IDs
+    # IDs from cli, a file (one per line) and/or games on a drive
+    def prefetch(self, args):
+        ids = list(args.opl_id)
+        if args.file:
+            with open(args.file) as f:
+                ids += [l.strip() for l in f if l.strip() and not l.startswith('#')]
+        if args.from_drive:
+            for entry in DriveCatalog(args.from_drive).scan().values():
+                if entry.opl_id:
+                    ids.append(entry.opl_id)
+
+        if not ids:
+            print("Error: No OPL-IDs given!")
+            return False
+
+        self.api = API()
+        if not self.api.enabled:
+            return False
+
+        failed = 0
+        for opl_id in sorted(set(ids)):
+            print("Prefetching Artwork for '%s'..." % opl_id)
+            failed += self.api.prefetch_artwork(opl_id)
+        print("Done! %d failed download(s)." % failed)
+        return failed == 0
+
+    # Import JSON/CSV metadata dump into offline database
+    def db_import(self, args):
+        if not is_file(args.dump):
+            print("Error: Dump file '%s' doesn't exist!" % args.dump)
+            return False
+
+        db = MetadataDB(args.db)
+        print("Importing '%s' into %s..." % (args.dump, db.filepath))
+        try:
+            inserted, updated, unchanged, skipped = db.import_dump(args.dump)
+        except Exception as e:
+            print("Error: Couldn't import dump:")
+            print(e)
+            return False
+        print("Done! %d new, %d updated, %d unchanged, %d skipped (no ID)" \
+                % (inserted, updated, unchanged, skipped))
+        print("%d games in database." % db.count())
+        db.close()
+        return True
+
+    # Lookup game in offline database
+    def db_lookup(self, args):
+        db = MetadataDB.open(args.db)
+        if not db:
+            print("Error: No metadata database found, use 'opl db import' first.")
+            return False
+        for id in args.id:
+            meta = db.get(id)
+            if meta:
+                print(json.dumps(meta, indent=2))
+            else:
+                print("Not found: %s" % id)
+        return True
+
+    # Register drive/library in search index & index its games
+    def index_add(self, args):
+        index = SearchIndex(args.index)
+        ok = True
+        for opl_drive in args.drives:
+            if not is_dir(opl_drive):
+                print("Error: '%s' isn't a directory!" % opl_drive)
+                ok = False
+                continue
+            index.add_drive(opl_drive, args.name)
+            added, removed, unchanged = index.update_drive(opl_drive, force=True)
+            print("Indexed %s: %d games" % (opl_drive, added + unchanged))
+        index.close()
+        return ok
+
+    def index_remove(self, args):
+        index = SearchIndex(args.index)
+        for opl_drive in args.drives:
+            if not index.remove_drive(opl_drive):
+                print("Warn: '%s' isn't registered." % opl_drive)
+        index.close()
+        return True
+
+    # Update index for all registered drives that are available & changed
+    def index_update(self, args):
+        index = SearchIndex(args.index)
+        for path, name in index.drives():
+            ret = index.update_drive(path, force=args.force)
+            if ret:
+                print("Updated %s (%s): %d added, %d removed, %d unchanged" % ((name, path) + ret))
+        index.close()
+        return True
+
+    def index_list(self, args):
+        index = SearchIndex(args.index)
+        for path, name in index.drives():
+            print(" [%s] %s %s" % (name, path, "" if is_dir(path) else "(offline)"))
+        index.close()
+        return True
+
+    # Search games on all registered drives
+    def search(self, args):
+        index = SearchIndex(args.index)
+        if not args.no_update:
+            for path, name in index.drives():
+                index.update_drive(path)
+
+        results = index.search(" ".join(args.query), args.limit)
+        if not results:
+            print("No games found.")
+        for score, name, path, type, opl_id, title, key in results:
+            print(" %3d%% [%s] %s  (%s: %s)" % (score * 100, opl_id, title, name, key))
+        index.close()
+        return True
+
+    # Convert games between ISO & UL-Format
+    #  --to iso: reassemble UL-Game "game" (OPL-ID) into an ISO
+    #  --to ul:  split ISO "game" (path or OPL-ID of an ISO on opl_drive)
+    def convert(self, args):
+        # Conversions move data, so their ul.cfg change is written right away
+        converter = ULConverter(args.opl_drive, ulcfg=self.get_ulcfg(args.opl_drive))
+        keep = args.keep or args.out is not None
+
+        if args.to == "iso":
+            dest = converter.ul_to_iso(args.game, args.out, keep)
+            if not dest:
+                return False
+            print("Done! Converted '%s' to %s" % (args.game, dest))
+            return True
+
+        iso_path = args.game
+        if not is_file(iso_path):
+            iso_path = None
+            for entry in DriveCatalog(args.opl_drive).scan().values():
+                if entry.type == "iso" and entry.opl_id == args.game.upper():
+                    iso_path = os.path.join(args.opl_drive, entry.key)
+                    break
+        if not iso_path:
+            print("Error: ISO '%s' not found!" % args.game)
+            return False
+
+        ulgame = converter.iso_to_ul(iso_path, args.title, keep)
+        if not ulgame:
+            return False
+        # Entries read back from ul.cfg hold the raw byte
+        parts = ulgame.parts[0] if isinstance(ulgame.parts, bytes) else int(ulgame.parts)
+        print("Done! Converted '%s' to UL-Game '%s' (%d parts)" \
+                % (os.path.basename(iso_path), ulgame.name, parts))
+        return True
+
+    # Check UL-Games for consistency of ul.cfg & part files
+    def verify(self, args):
+        if not args.ul:
+            print("Nothing to verify, use --ul to check UL-Games.")
+            return False
+
+        verifier = ULVerifier(args.opl_drive)
+        print("Verifying UL-Games on %s%s..." % (args.opl_drive, " (deep)" if args.deep else ""))
+        if args.deep:
+            results = verifier.verify_deep(args.workers)
+        else:
+            results = verifier.verify()
+
+        failed = 0
+        for r in results:
+            if r.ok():
+                print(" [OK]   [%s] %s (%d parts)" % (r.opl_id, r.name, len(r.parts)))
+            else:
+                failed += 1
+                print(" [FAIL] [%s] %s" % (r.opl_id, r.name if r.name else ""))
+                for problem in r.problems:
+                    print("          - " + problem)
+            for p in sorted(r.hashes):
+                print("          %02X sha1: %s" % (p, r.hashes[p]))
+
+        print("\n%d game(s) checked, %d with problems." % (len(results), failed))
+        return failed == 0
+
+    # Report fragmentation of all ISOs & UL-parts on opl_drive
+    # OPL refuses fragmented games on USB, so suggest re-copying them
+    def check_frag(self, args):
+        files = []
+        for dir in ['CD', 'DVD']:
+            if not is_dir(os.path.join(args.opl_drive, dir)):
+                continue
+            for f in sorted(os.listdir(os.path.join(args.opl_drive, dir))):
+                if DriveCatalog.iso_regex.match(f):
+                    files.append(os.path.join(dir, f))
+        for f in sorted(os.listdir(args.opl_drive)):
+            if DriveCatalog.ul_regex.match(f):
+                files.append(f)
+
+        print("Checking fragmentation on %s:" % args.opl_drive)
+        fragmented = []
+        for f in files:
+            extents = count_extents(os.path.join(args.opl_drive, f))
+            if extents is None:
+                print(" [  ?] %s (FIEMAP not supported)" % f)
+                continue
+            print(" [%3d] %s" % (extents, f))
+            if extents > args.max_extents:
+                fragmented.append(f)
+
+        if fragmented:
+            print("\n%d file(s) with more than %d extent(s), please re-copy:" \
+                    % (len(fragmented), args.max_extents))
+            for f in fragmented:
+                print(" " + f)
+            return False
+        print("\nAll games are unfragmented!")
+        return True
+
+    # Create formatted virtual memory card(s) in VMC/
+    #  - one card per given OPL-ID (or every game on opl_drive with --all)
+    #  - named after the game & set as its memory card 1 in CFG/<OPL-ID>.cfg
+    #  - or a single unassigned card with --name
+    def vmc_create(self, args):
+        vmc_dir = os.path.join(args.opl_drive, "VMC")
+        if not is_dir(vmc_dir):
+            os.mkdir(vmc_dir)
+        try:
+            image = VMCImage(args.size)
+        except ValueError as e:
+            print("Error: %s" % e)
+            return False
+
+        if args.name:
+            filepath = os.path.join(vmc_dir, args.name + ".bin")
+            if not image.create(filepath, args.force):
+                return False
+            print("Created %s (%dMB)" % (filepath, args.size))
+            return True
+
+        opl_ids = [i.upper() for i in args.opl_id]
+        if args.all:
+            opl_ids += sorted(set(e.opl_id for e in DriveCatalog(args.opl_drive).scan().values() if e.opl_id))
+        if not opl_ids:
+            print("Nothing to do, give OPL-ID(s), --all or --name.")
+            return False
+
+        created = 0
+        for opl_id in dict.fromkeys(opl_ids):
+            filepath = os.path.join(vmc_dir, opl_id + ".bin")
+            if not image.create(filepath, args.force):
+                continue
+            if not args.no_assign:
+                assign_vmc(args.opl_drive, opl_id, opl_id)
+            print("Created %s (%dMB)" % (filepath, args.size))
+            created += 1
+        print("\n%d VMC(s) created." % created)
+        return created == len(dict.fromkeys(opl_ids))
+
+    # Run all jobs of a JSON manifest in this process, see libopl.batch
+    def batch(self, args):
+        runner = BatchRunner(self, args.workers)
+        if not runner.load(args.manifest):
+            return False
+        return runner.run()
+
+    # Save state of opl_drive into a snapshot file
+    #  --deep: also hash all UL-parts (reads every part)
+    def snapshot_export(self, args):
+        hashes = {}
+        if args.deep:
+            print("Hashing UL-Games...")
+            for r in ULVerifier(args.opl_drive).verify_deep(args.workers):
+                if r.hashes:
+                    hashes["ul." + r.opl_id] = ",".join("%02X:%s" % (p, r.hashes[p]) \
+                            for p in sorted(r.hashes))
+        count = SnapshotWriter(args.opl_drive).write(args.file, hashes)
+        print("Saved %d record(s) of %s to %s (%d bytes)" \
+                % (count, args.opl_drive, args.file, os.path.getsize(args.file)))
+        return True
+
+    # One line summary per snapshot
+    def snapshot_show(self, args):
+        ok = True
+        for filepath in args.file:
+            try:
+                snapshot = Snapshot(filepath)
+            except (OSError, ValueError) as e:
+                print("Error: %s" % e)
+                ok = False
+                continue
+            if args.verbose:
+                for e in snapshot.games():
+                    print(" [%s] %-12s %-40s %6d MB %s" % ("UL " if e.type == 1 else "ISO", \
+                            e.opl_id, e.title, e.size >> 20, ",".join(e.artwork())))
+            games = snapshot.games()
+            print("%s: %s, %d game(s), %d MB used by games, %d/%d MB free, taken %s" % (filepath, \
+                    snapshot.drive, len(games), sum(e.size for e in games) >> 20, \
+                    snapshot.free >> 20, snapshot.total >> 20, \
+                    time.strftime("%Y-%m-%d %H:%M", time.localtime(snapshot.created / 1e9))))
+            snapshot.close()
+        return ok
+
+    # Diff snapshot against another snapshot or a live drive
+    def snapshot_diff(self, args):
+        try:
+            old = Snapshot(args.old)
+            if is_dir(args.new):
+                changes = diff_live(old, args.new, args.full)
+            else:
+                changes = diff_snapshots(old, Snapshot(args.new))
+        except (OSError, ValueError) as e:
+            print("Error: %s" % e)
+            return False
+
+        delta = 0
+        for status, a, b in changes:
+            e = b if b else a
+            if status == "~":
+                print(" ~ %-16s %s (%s)" % (e.key, e.title, ", ".join(a.compare(b))))
+                delta += b.size - a.size
+            else:
+                print(" %s %-16s %s" % (status, e.key, e.title))
+                delta += e.size if status == "+" else -e.size
+        print("\n%d change(s), %+.1f MB" % (len(changes), delta / 2**20))
+        return True
+
+    # Watch dropdir & add every finished image to opl_drive,
+    # same as running "add" for each of them
+    def watch(self, args):
+        if not is_dir(args.dropdir):
+            print("Error: dropdir '%s' doesn't exist!" % args.dropdir)
+            return False
+        if not self.api:
+            self.api = API(transcode=args.resize)
+
+        def ingest(filepath):
+            print("New image: %s" % filepath)
+            add_args = argparse.Namespace(opl_drive=args.opl_drive, src_file=[filepath], \
+                    rename=args.rename, force=args.force, ul=args.ul, resize=args.resize, \
+                    sync=args.sync, sync_interval=args.sync_interval)
+            if self.add(add_args) and args.remove_source:
+                os.remove(filepath)
+
+        watcher = DropFolderWatcher(args.dropdir, ingest, args.workers, \
+                args.queue_size, args.debounce)
+        print("Watching %s for new images, press Ctrl+C to stop..." % args.dropdir)
+        try:
+            watcher.run(args.existing)
+        except KeyboardInterrupt:
+            print("Stopping, waiting for running jobs...")
+        return True
+
         # Create OPL Folders / stuff
     def init(self, args):
         print("Inititalizing OPL-Drive...")
@@ -286,6 +735,11 @@ def main():
     opl = POPLManager()
 
     parser = argparse.ArgumentParser()
+    parser.add_argument("--read-limit", help="Limit reading to N MB/s", type=float, default=None)
+    parser.add_argument("--write-limit", help="Limit writing to N MB/s", type=float, default=None)
+    parser.add_argument("--http-limit", help="Limit API/artwork requests to N per second", type=float, default=None)
+    parser.add_argument("--config", "-c", help="Path to config file (Default: ~/.config/opl.ini)", default=None)
+    parser.add_argument("--set", help="Override config setting, e.g. --set API.CONCURRENCY=16", action='append', default=[], metavar="SECTION.KEY=VALUE")
     subparsers = parser.add_subparsers(help='Choose your path...')
 
     list_parser = subparsers.add_parser("list", help="List Games on OPL-Drive")
@@ -297,16 +751,29 @@ def main():
     add_parser.add_argument("--rename", "-r" , help="Rename Game by obtaining it's title from API", action='store_true')
     add_parser.add_argument("--force", "-f" , help="Force overwriting of existing files", action='store_true', default=False)
     add_parser.add_argument("--ul", "-u" , help="Force UL-Game converting", action='store_true')
+    add_parser.add_argument("--resize", help="Resize/re-encode artwork to OPL's recommended formats (needs Pillow)", action='store_true')
+    add_parser.add_argument("--sync", "-s", help="When to flush written data to disk (Default: interval)", choices=FileCopier.SYNC_POLICIES, default=FileCopier.SYNC_INTERVAL)
+    add_parser.add_argument("--sync-interval", help="Flush every N MiB with '--sync interval' (Default: 64)", type=int, default=64)
     add_parser.add_argument("opl_drive", help="Path to OPL - e.g. your USB- or SMB-Drive\nExample: /media/usb")
     add_parser.add_argument("src_file",nargs='+', help="Media/ISO Source File")
     add_parser.set_defaults(func=opl.add)
 
     art_parser = subparsers.add_parser("artwork", help="Download Artwork onto opl_drive")
     art_parser.add_argument("--force", "-f" , help="Force replacement of existing artwork", action='store_true')
+    art_parser.add_argument("--resize", help="Resize/re-encode artwork to OPL's recommended formats (needs Pillow)", action='store_true')
     art_parser.add_argument("opl_drive", help="Path to OPL - e.g. your USB- or SMB-Drive\nExample: /media/usb")
     art_parser.set_defaults(func=opl.download_artwork)
 
+    prefetch_parser = subparsers.add_parser("prefetch", help="Download artwork into local cache, without opl_drive")
+    prefetch_parser.add_argument("--file", "-F", help="File with one OPL-ID per line", default=None)
+    prefetch_parser.add_argument("--from-drive", "-d", help="Prefetch for all games on this drive/library", default=None)
+    prefetch_parser.add_argument("opl_id", nargs='*', help="OPL-ID(s) of games")
+    prefetch_parser.set_defaults(func=opl.prefetch)
+
     fix_parser = subparsers.add_parser("fix", help="rename/fix media filenames")
+    fix_parser.add_argument("--dry-run", "-n", help="Only show what would be renamed", action='store_true')
+    fix_parser.add_argument("--resume", help="Finish an interrupted fix", action='store_true')
+    fix_parser.add_argument("--rollback", help="Undo an interrupted fix", action='store_true')
     fix_parser.add_argument("opl_drive", help="Path to OPL - e.g. your USB- or SMB-Drive\nExample: /media/usb")
     fix_parser.set_defaults(func=opl.fix)
 
@@ -314,6 +781,113 @@ def main():
     init_parser.add_argument("opl_drive", help="Path to OPL - e.g. your USB- or SMB-Drive\nExample: /media/usb")
     init_parser.set_defaults(func=opl.init)
 
+    convert_parser = subparsers.add_parser("convert", help="Convert game between ISO & UL-Format")
+    convert_parser.add_argument("--to", "-t", help="Target format", choices=["iso", "ul"], required=True)
+    convert_parser.add_argument("--keep", "-k", help="Keep the source (needs space for a full copy)", action='store_true')
+    convert_parser.add_argument("--out", "-o", help="ISO target path, e.g. SMB-share (implies --keep)", default=None)
+    convert_parser.add_argument("--title", help="Title for the UL-Game (Default: from ISO filename)", default=None)
+    convert_parser.add_argument("opl_drive", help="Path to OPL - e.g. your USB- or SMB-Drive\nExample: /media/usb")
+    convert_parser.add_argument("game", help="OPL-ID of UL-Game (--to iso) or ISO path/OPL-ID (--to ul)")
+    convert_parser.set_defaults(func=opl.convert)
+
+    verify_parser = subparsers.add_parser("verify", help="Check games on OPL-Drive for consistency")
+    verify_parser.add_argument("--ul", help="Verify UL-Games & ul.cfg", action='store_true')
+    verify_parser.add_argument("--deep", help="Also read & hash all parts (slow)", action='store_true')
+    verify_parser.add_argument("--workers", "-w", help="Parallel readers in deep mode (Default: 4)", type=int, default=4)
+    verify_parser.add_argument("opl_drive", help="Path to OPL - e.g. your USB- or SMB-Drive\nExample: /media/usb")
+    verify_parser.set_defaults(func=opl.verify)
+
+    frag_parser = subparsers.add_parser("check-frag", help="Check ISOs & UL-parts for fragmentation")
+    frag_parser.add_argument("--max-extents", "-m", help="Max. number of extents before a file counts as fragmented (Default: 1)", type=int, default=1)
+    frag_parser.add_argument("opl_drive", help="Path to OPL - e.g. your USB- or SMB-Drive\nExample: /media/usb")
+    frag_parser.set_defaults(func=opl.check_frag)
+
+    db_parser = subparsers.add_parser("db", help="Manage offline metadata database")
+    db_subparsers = db_parser.add_subparsers(help='Database commands')
+    db_import_parser = db_subparsers.add_parser("import", help="Import/update metadata from JSON/CSV dump")
+    db_import_parser.add_argument("--db", help="Path to database (Default: ~/.cache/libopl/metadata.db)", default=None)
+    db_import_parser.add_argument("dump", help="JSON or CSV dump of game metadata")
+    db_import_parser.set_defaults(func=opl.db_import)
+    db_lookup_parser = db_subparsers.add_parser("lookup", help="Lookup game(s) in database")
+    db_lookup_parser.add_argument("--db", help="Path to database (Default: ~/.cache/libopl/metadata.db)", default=None)
+    db_lookup_parser.add_argument("id", nargs='+', help="Serial / OPL-ID of game")
+    db_lookup_parser.set_defaults(func=opl.db_lookup)
+
+    index_parser = subparsers.add_parser("index", help="Manage drives/libraries in search index")
+    index_subparsers = index_parser.add_subparsers(help='Index commands')
+    index_add_parser = index_subparsers.add_parser("add", help="Register & index drive(s)")
+    index_add_parser.add_argument("--name", "-n", help="Label for the drive (Default: directory name)", default=None)
+    index_add_parser.add_argument("drives", nargs='+', help="Path to OPL-Drive or game library")
+    index_add_parser.set_defaults(func=opl.index_add)
+    index_remove_parser = index_subparsers.add_parser("remove", help="Remove drive(s) from index")
+    index_remove_parser.add_argument("drives", nargs='+', help="Path to OPL-Drive or game library")
+    index_remove_parser.set_defaults(func=opl.index_remove)
+    index_update_parser = index_subparsers.add_parser("update", help="Re-index changed drives")
+    index_update_parser.add_argument("--force", "-f", help="Rescan drives even if unchanged", action='store_true')
+    index_update_parser.set_defaults(func=opl.index_update)
+    index_list_parser = index_subparsers.add_parser("list", help="List registered drives")
+    index_list_parser.set_defaults(func=opl.index_list)
+    for p in [index_add_parser, index_remove_parser, index_update_parser, index_list_parser]:
+        p.add_argument("--index", help="Path to index (Default: ~/.cache/libopl/search.db)", default=None)
+
+    search_parser = subparsers.add_parser("search", help="Search games on all indexed drives")
+    search_parser.add_argument("--index", help="Path to index (Default: ~/.cache/libopl/search.db)", default=None)
+    search_parser.add_argument("--limit", "-l", help="Max. number of results (Default: 20)", type=int, default=20)
+    search_parser.add_argument("--no-update", help="Don't check drives for changes first", action='store_true')
+    search_parser.add_argument("query", nargs='+', help="Title, OPL-ID or filename")
+    search_parser.set_defaults(func=opl.search)
+
+    snap_parser = subparsers.add_parser("snapshot", help="Save & compare drive states offline")
+    snap_subparsers = snap_parser.add_subparsers(help='Snapshot commands')
+    snap_export_parser = snap_subparsers.add_parser("export", help="Save state of opl_drive to file")
+    snap_export_parser.add_argument("--deep", help="Also hash all UL-parts (slow)", action='store_true')
+    snap_export_parser.add_argument("--workers", "-w", help="Parts hashed in parallel with --deep (Default: 4)", type=int, default=4)
+    snap_export_parser.add_argument("opl_drive", help="Path to OPL - e.g. your USB- or SMB-Drive\nExample: /media/usb")
+    snap_export_parser.add_argument("file", help="Snapshot file")
+    snap_export_parser.set_defaults(func=opl.snapshot_export)
+    snap_show_parser = snap_subparsers.add_parser("show", help="Summarize snapshot(s)")
+    snap_show_parser.add_argument("--verbose", "-v", help="List all games", action='store_true')
+    snap_show_parser.add_argument("file", nargs='+', help="Snapshot file(s)")
+    snap_show_parser.set_defaults(func=opl.snapshot_show)
+    snap_diff_parser = snap_subparsers.add_parser("diff", help="Compare snapshot with snapshot or live drive")
+    snap_diff_parser.add_argument("--full", help="Stat all files of a live drive, not only new ones", action='store_true')
+    snap_diff_parser.add_argument("old", help="Snapshot file")
+    snap_diff_parser.add_argument("new", help="Snapshot file or path to OPL-Drive")
+    snap_diff_parser.set_defaults(func=opl.snapshot_diff)
+
+    batch_parser = subparsers.add_parser("batch", help="Run jobs (init, add, delete, fix, artwork, convert) from a JSON manifest")
+    batch_parser.add_argument("--workers", "-w", help="Max. jobs running in parallel (Default: 4)", type=int, default=None)
+    batch_parser.add_argument("manifest", help="JSON manifest, see libopl/batch.py")
+    batch_parser.set_defaults(func=opl.batch)
+
+    vmc_parser = subparsers.add_parser("vmc", help="Manage virtual memory cards")
+    vmc_subparsers = vmc_parser.add_subparsers(help='VMC commands')
+    vmc_create_parser = vmc_subparsers.add_parser("create", help="Create formatted VMC(s) for game(s)")
+    vmc_create_parser.add_argument("--size", help="Card size in MB (Default: 8)", type=int, choices=VMCImage.SIZES, default=8)
+    vmc_create_parser.add_argument("--all", "-a", help="Create VMC for every game on opl_drive", action='store_true')
+    vmc_create_parser.add_argument("--name", "-n", help="Create a single, unassigned VMC with this name", default=None)
+    vmc_create_parser.add_argument("--no-assign", help="Don't set VMC as memory card in the game's config", action='store_true')
+    vmc_create_parser.add_argument("--force", "-f" , help="Force overwriting of existing VMCs", action='store_true', default=False)
+    vmc_create_parser.add_argument("opl_drive", help="Path to OPL - e.g. your USB- or SMB-Drive\nExample: /media/usb")
+    vmc_create_parser.add_argument("opl_id", nargs='*', help="OPL-ID of game(s)")
+    vmc_create_parser.set_defaults(func=opl.vmc_create)
+
+    watch_parser = subparsers.add_parser("watch", help="Watch folder & add new images to OPL-Drive")
+    watch_parser.add_argument("--existing", "-e", help="Also add images already in dropdir", action='store_true')
+    watch_parser.add_argument("--remove-source", help="Delete images from dropdir once added", action='store_true')
+    watch_parser.add_argument("--workers", "-w", help="Images added in parallel (Default: 1)", type=int, default=1)
+    watch_parser.add_argument("--queue-size", help="Max. images waiting for a worker (Default: 16)", type=int, default=16)
+    watch_parser.add_argument("--debounce", help="Seconds an image must stay unchanged (Default: 0.5)", type=float, default=0.5)
+    watch_parser.add_argument("--rename", "-r" , help="Rename Game by obtaining it's title from API", action='store_true')
+    watch_parser.add_argument("--force", "-f" , help="Force overwriting of existing files", action='store_true', default=False)
+    watch_parser.add_argument("--ul", "-u" , help="Force UL-Game converting", action='store_true')
+    watch_parser.add_argument("--resize", help="Resize/re-encode artwork to OPL's recommended formats (needs Pillow)", action='store_true')
+    watch_parser.add_argument("--sync", "-s", help="When to flush written data to disk (Default: interval)", choices=FileCopier.SYNC_POLICIES, default=FileCopier.SYNC_INTERVAL)
+    watch_parser.add_argument("--sync-interval", help="Flush every N MiB with '--sync interval' (Default: 64)", type=int, default=64)
+    watch_parser.add_argument("dropdir", help="Folder to watch for new ISOs")
+    watch_parser.add_argument("opl_drive", help="Path to OPL - e.g. your USB- or SMB-Drive\nExample: /media/usb")
+    watch_parser.set_defaults(func=opl.watch)
+
     del_parser = subparsers.add_parser("delete", help="Delete game from Drive")
     del_parser.add_argument("opl_drive", help="Path to OPL - e.g. your USB- or SMB-Drive\nExample: /media/usb")
     del_parser.add_argument("opl_id",nargs='+', help="OPL-ID of Media/ISO File to delete")
@@ -321,17 +895,33 @@ def main():
     args = parser.parse_args()
     opl.set_args(args)
 
+    if args.config:
+        settings.set_path(args.config)
+    for setting in args.set:
+        match = re.match(r'^([^.=]+)\.([^=]+)=(.*)$', setting)
+        if not match:
+            print("Error: Invalid setting '%s', use SECTION.KEY=VALUE" % setting)
+            sys.exit(1)
+        if not settings.set(*match.groups()):
+            sys.exit(1)
+
+    # cli limits win over [LIMITS] in config
+    limits = [args.read_limit, args.write_limit, args.http_limit]
+    for i, key in enumerate(["READ", "WRITE", "HTTP"]):
+        if limits[i] is None:
+            limits[i] = config("LIMITS", key)
+    throttle.set_limits(*limits)
+
     if hasattr(args, 'opl_drive'):
         if not is_dir(args.opl_drive):
             print("Error: opl_drive directory doesn't exist!")
             sys.exit(1)
     
-    if hasattr(args, 'func'):
-        args.func(args)
-    else: 
+    if not hasattr(args, 'func'):
         parser.print_help(sys.stderr)
         sys.exit(1)
-    sys.exit(0)
+    # Some commands don't return anything, only False is a failure
+    sys.exit(0 if args.func(args) is not False else 1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+#####
+# Search Index
+# Trigram inverted index over titles, OPL-IDs & filenames of all
+# registered drives/libraries. Lives in a local SQLite database, so
+# searching never touches the drives themselves.
+#
+# Drives are only rescanned when their DriveCatalog.signature() changed,
+# and only added/removed/changed entries are written to the index.
+from pathlib import Path
+from libopl.catalog import DriveCatalog
+from libopl.common import is_dir, config
+
+import os
+import re
+import sqlite3
+
+
+# Split text into lowercase trigrams, words padded like pg_trgm:
+# "Foo" -> "  f", " fo", "foo", "oo "
+def trigrams(text):
+    grams = set()
+    for word in re.split(r'[^0-9a-z]+', str(text).lower()):
+        if not word:
+            continue
+        word = "  " + word + " "
+        for i in range(len(word) - 2):
+            grams.add(word[i:i+3])
+    return grams
+
+
+class SearchIndex():
+    DEFAULT_PATH = str(Path.home()) + "/.cache/libopl/search.db"
+
+    # Max. candidates fetched from the index before ranking
+    CANDIDATES = 500
+
+    # Max. postings read per query. Rare trigrams are used first,
+    # very common ones (e.g. "sle" of every SLES-ID) are dropped beyond that.
+    POSTINGS = 20000
+
+    filepath = None
+    conn = None
+
+    def __init__(self, filepath=None):
+        if not filepath:
+            filepath = config("SEARCH", "PATH") or SearchIndex.DEFAULT_PATH
+        self.filepath = filepath
+
+        dirpath = os.path.dirname(self.filepath)
+        if dirpath and not is_dir(dirpath):
+            os.makedirs(dirpath)
+        self.conn = sqlite3.connect(self.filepath)
+        self.conn.executescript("""
+            PRAGMA foreign_keys = ON;
+            CREATE TABLE IF NOT EXISTS drives (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                name TEXT,
+                signature TEXT
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY,
+                drive_id INTEGER NOT NULL REFERENCES drives(id) ON DELETE CASCADE,
+                key TEXT NOT NULL,
+                type TEXT,
+                opl_id TEXT,
+                title TEXT,
+                filename TEXT,
+                size INTEGER,
+                ngrams INTEGER,
+                UNIQUE (drive_id, key)
+            );
+            CREATE TABLE IF NOT EXISTS grams (
+                gram TEXT NOT NULL,
+                entry_id INTEGER NOT NULL REFERENCES entries(id) ON DELETE CASCADE,
+                PRIMARY KEY (gram, entry_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS grams_entry ON grams (entry_id);
+            CREATE TABLE IF NOT EXISTS gram_stats (
+                gram TEXT PRIMARY KEY,
+                df INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TRIGGER IF NOT EXISTS grams_insert AFTER INSERT ON grams BEGIN
+                INSERT INTO gram_stats (gram, df) VALUES (NEW.gram, 1)
+                    ON CONFLICT (gram) DO UPDATE SET df = df + 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS grams_delete AFTER DELETE ON grams BEGIN
+                UPDATE gram_stats SET df = df - 1 WHERE gram = OLD.gram;
+            END;
+        """)
+        self.conn.commit()
+
+    # Register drive/library, returns drive id
+    def add_drive(self, opl_drive, name=None):
+        opl_drive = os.path.abspath(opl_drive)
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO drives (path, name) VALUES (?, ?)", \
+                    (opl_drive, name if name else os.path.basename(opl_drive)))
+            if name:
+                self.conn.execute("UPDATE drives SET name = ? WHERE path = ?", (name, opl_drive))
+        return self.conn.execute("SELECT id FROM drives WHERE path = ?", (opl_drive,)).fetchone()[0]
+
+    def remove_drive(self, opl_drive):
+        with self.conn:
+            cur = self.conn.execute("DELETE FROM drives WHERE path = ?", (os.path.abspath(opl_drive),))
+        return cur.rowcount > 0
+
+    # Return: list of (path, name)
+    def drives(self):
+        return self.conn.execute("SELECT path, name FROM drives ORDER BY name").fetchall()
+
+    # Rescan drive & update index, if its contents changed
+    # Return: (added, removed, unchanged) or None if skipped
+    def update_drive(self, opl_drive, force=False):
+        opl_drive = os.path.abspath(opl_drive)
+        row = self.conn.execute("SELECT id, signature FROM drives WHERE path = ?", \
+                (opl_drive,)).fetchone()
+        if not row or not is_dir(opl_drive):
+            return None
+        drive_id, old_signature = row
+
+        catalog = DriveCatalog(opl_drive)
+        signature = catalog.signature()
+        if signature == old_signature and not force:
+            return None
+
+        known = {}
+        for id, key, title, filename, size in self.conn.execute( \
+                "SELECT id, key, title, filename, size FROM entries WHERE drive_id = ?", (drive_id,)):
+            known[key] = (id, (title, filename, size))
+
+        added = removed = unchanged = 0
+        with self.conn:
+            for key, entry in catalog.scan().items():
+                old = known.pop(key, None)
+                if old and old[1] == (entry.title, entry.filename, entry.size):
+                    unchanged += 1
+                    continue
+                if old:
+                    self.conn.execute("DELETE FROM entries WHERE id = ?", (old[0],))
+                self.__insert(drive_id, entry)
+                added += 1
+
+            for key, (id, _) in known.items():
+                self.conn.execute("DELETE FROM entries WHERE id = ?", (id,))
+                removed += 1
+
+            self.conn.execute("UPDATE drives SET signature = ? WHERE id = ?", (signature, drive_id))
+        return (added, removed, unchanged)
+
+    def __insert(self, drive_id, entry):
+        grams = trigrams(" ".join(filter(None, [entry.title, entry.opl_id, entry.filename])))
+        cur = self.conn.execute("INSERT INTO entries (drive_id, key, type, opl_id, title, " \
+                "filename, size, ngrams) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (drive_id, entry.key, \
+                entry.type, entry.opl_id, entry.title, entry.filename, entry.size, len(grams)))
+        self.conn.executemany("INSERT INTO grams (gram, entry_id) VALUES (?, ?)", \
+                [(g, cur.lastrowid) for g in grams])
+
+    # Search index, ranked by share of query trigrams found in an entry,
+    # ties broken by trigram similarity (shorter/closer titles first)
+    # Return: list of (score, drive name, drive path, type, opl_id, title, key)
+    def search(self, query, limit=20):
+        grams = list(trigrams(query))
+        if not grams:
+            return []
+
+        # Rarest trigrams first, within the postings budget
+        df = dict(self.conn.execute("SELECT gram, df FROM gram_stats WHERE gram IN (%s)" \
+                % ",".join("?" * len(grams)), grams))
+        grams.sort(key=lambda g: df.get(g, 0))
+        postings = 0
+        for i, gram in enumerate(grams):
+            postings += df.get(gram, 0)
+            if postings > SearchIndex.POSTINGS and i > 0:
+                grams = grams[:i]
+                break
+
+        candidates = self.conn.execute("SELECT entry_id, COUNT(*) AS hits FROM grams " \
+                "WHERE gram IN (%s) GROUP BY entry_id ORDER BY hits DESC LIMIT ?" \
+                % ",".join("?" * len(grams)), grams + [SearchIndex.CANDIDATES]).fetchall()
+        if not candidates:
+            return []
+        hits = dict(candidates)
+
+        results = []
+        for id, ngrams, name, path, type, opl_id, title, key in self.conn.execute( \
+                "SELECT e.id, e.ngrams, d.name, d.path, e.type, e.opl_id, e.title, e.key " \
+                "FROM entries e JOIN drives d ON d.id = e.drive_id WHERE e.id IN (%s)" \
+                % ",".join("?" * len(hits)), list(hits)):
+            score = hits[id] / float(len(grams))
+            similarity = hits[id] / float(len(grams) + ngrams - hits[id])
+            results.append((score, similarity, (name, path, type, opl_id, title, key)))
+
+        results.sort(key=lambda r: (r[0], r[1]), reverse=True)
+        return [(r[0],) + r[2] for r in results[:limit]]
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
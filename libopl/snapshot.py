@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+###
+# Drive Snapshots
+# Compact, versioned binary image of a drive's state (ISOs, ul.cfg entries,
+# part sizes, artwork, hashes where known) for offline planning.
+#
+# Layout (little endian), designed to be mmap'ed & read lazily:
+#   header   magic, version, created, drive size & free space, counts, offsets
+#   records  fixed size, sorted by key (binary search, merge-join diffs)
+#   strings  string/blob heap referenced by (offset, length)
+#
+# Besides games, the mtimes of the game folders & ul.cfg are recorded,
+# so a diff against a live drive only lists folders that changed & only
+# stats files that are new (or all files in changed folders with "full").
+from libopl.catalog import DriveCatalog, CatalogEntry
+
+import os
+import copy
+import mmap
+import time
+import struct
+
+MAGIC = b"OPLSNAP\0"
+VERSION = 1
+
+# magic, version, flags, created (ns), drive size, drive free,
+# records, records offset, strings offset, strings size, drive path (offset, length)
+_header = struct.Struct("<8sHHqQQIIIIIH")
+
+# type, artwork flags, parts, crc32, size, mtime (ns),
+# key, opl_id, title, hash, part sizes: (offset, length) each
+_record = struct.Struct("<BBHIQqIHIHIHIHIH")
+
+
+class SnapshotEntry():
+    ISO = 0
+    UL = 1
+    # Folder/ul.cfg mtime, not a game
+    DIR = 2
+
+    # Artwork types & their bit in "art"
+    ART_TYPES = ["COV", "COV2", "ICO", "LAB", "LGO", "BG", "SCR", "SCR2"]
+
+    def __init__(self, type, key, opl_id=None, title=None, size=0, mtime=0, \
+            crc32=0, parts=None, art=0, hash=None):
+        self.type = type
+        self.key = key
+        self.opl_id = opl_id
+        self.title = title
+        self.size = size
+        # ns
+        self.mtime = mtime
+        self.crc32 = crc32
+        # UL only: list of part sizes
+        self.parts = parts if parts else []
+        self.art = art
+        self.hash = hash
+
+    # Names of present artwork types
+    def artwork(self):
+        return [t for i, t in enumerate(SnapshotEntry.ART_TYPES) if self.art & (1 << i)]
+
+    # Return: list of changed fields
+    def compare(self, other):
+        fields = ["title", "size", "parts", "art", "crc32"]
+        changed = [f for f in fields if getattr(self, f) != getattr(other, f)]
+        if self.mtime != other.mtime:
+            changed.append("mtime")
+        return changed
+
+    def __repr__(self):
+        return "<SnapshotEntry %d %s>" % (self.type, self.key)
+
+
+####
+# Read a snapshot file (mmap'ed, records are decoded on access)
+class Snapshot():
+    filepath = None
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with open(filepath, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < _header.size:
+            raise ValueError("'%s' is too small for a snapshot" % filepath)
+        magic, self.version, flags, self.created, self.total, self.free, self.count, \
+                self.records_offset, self.strings_offset, self.strings_size, \
+                path_offset, path_len = _header.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError("'%s' is not a snapshot" % filepath)
+        if self.version > VERSION:
+            raise ValueError("Snapshot '%s' has unsupported version %d" % (filepath, self.version))
+        self.drive = self.__string(path_offset, path_len)
+
+    def __len__(self):
+        return self.count
+
+    def __blob(self, offset, length):
+        start = self.strings_offset + offset
+        return self.data[start:start + length]
+
+    def __string(self, offset, length):
+        if not length:
+            return None
+        return self.__blob(offset, length).decode("utf-8")
+
+    # Key of record i, without decoding the rest
+    def key(self, i):
+        offset = self.records_offset + i * _record.size
+        key_offset, key_len = struct.unpack_from("<IH", self.data, offset + 24)
+        return self.__string(key_offset, key_len)
+
+    def entry(self, i):
+        type, art, parts, crc32, size, mtime, key_o, key_l, id_o, id_l, title_o, title_l, \
+                hash_o, hash_l, parts_o, parts_l = _record.unpack_from(self.data, \
+                self.records_offset + i * _record.size)
+        part_sizes = list(struct.unpack("<%dQ" % parts, self.__blob(parts_o, parts_l))) \
+                if parts_l else []
+        return SnapshotEntry(type, self.__string(key_o, key_l), self.__string(id_o, id_l), \
+                self.__string(title_o, title_l), size, mtime, crc32, part_sizes, art, \
+                self.__string(hash_o, hash_l))
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.entry(i)
+
+    # Binary search for key
+    # Return: SnapshotEntry or None
+    def find(self, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.key(lo) == key:
+            return self.entry(lo)
+        return None
+
+    # Games only
+    def games(self):
+        return [e for e in self if e.type != SnapshotEntry.DIR]
+
+    # Return: dict of folder: mtime
+    def dirs(self):
+        return dict((e.key, e.mtime) for e in self if e.type == SnapshotEntry.DIR)
+
+    def close(self):
+        self.data.close()
+
+
+####
+# Record a drive into a snapshot
+class SnapshotWriter():
+    # Folders/files whose mtime tells if anything in them changed
+    DIRS = DriveCatalog.ISO_DIRS + ["ART", ".", "ul.cfg"]
+
+    opl_drive = None
+
+    def __init__(self, opl_drive):
+        self.opl_drive = opl_drive
+        self.catalog = DriveCatalog(opl_drive)
+
+    # Artwork flags per OPL_ID
+    def artwork(self):
+        art = {}
+        for opl_id, types in self.catalog.scan_artwork().items():
+            for t in types:
+                if t in SnapshotEntry.ART_TYPES:
+                    art[opl_id] = art.get(opl_id, 0) | 1 << SnapshotEntry.ART_TYPES.index(t)
+        return art
+
+    # SnapshotEntry from a CatalogEntry
+    @staticmethod
+    def from_catalog(e):
+        if e.type == CatalogEntry.UL:
+            return SnapshotEntry(SnapshotEntry.UL, e.key, e.opl_id, e.title, e.size, 0, \
+                    e.crc32, [e.parts[p] for p in sorted(e.parts)])
+        return SnapshotEntry(SnapshotEntry.ISO, e.key, e.opl_id, e.title, e.size, e.mtime)
+
+    # Entry for ISO "name" in folder "dir"
+    @staticmethod
+    def iso_entry(dir, name, st):
+        return SnapshotWriter.from_catalog(DriveCatalog.iso_entry(dir, name, st))
+
+    def scan_iso(self, dir):
+        return [SnapshotWriter.from_catalog(e) for e in self.catalog.scan_iso_dir(dir)]
+
+    # ul.cfg entries & sizes of their parts
+    def scan_ul(self):
+        return [SnapshotWriter.from_catalog(e) for e in self.catalog.scan_ul()]
+
+    # hashes: optional {key: hash string}, e.g. sha1's of UL-parts
+    # Return: list of SnapshotEntry, sorted by key
+    def scan(self, hashes=None):
+        hashes = hashes if hashes else {}
+        art = self.artwork()
+        entries = self.scan_ul()
+        for dir in DriveCatalog.ISO_DIRS:
+            entries += self.scan_iso(dir)
+        for e in entries:
+            e.art = art.get(e.opl_id, 0)
+            e.hash = hashes.get(e.key)
+        for d in SnapshotWriter.DIRS:
+            try:
+                mtime = os.stat(os.path.join(self.opl_drive, d)).st_mtime_ns
+            except OSError:
+                continue
+            entries.append(SnapshotEntry(SnapshotEntry.DIR, d, mtime=mtime))
+        return sorted(entries, key=lambda e: e.key)
+
+    # Write snapshot of opl_drive to filepath (atomically)
+    # Return: number of records
+    def write(self, filepath, hashes=None):
+        entries = self.scan(hashes)
+
+        strings = bytearray()
+        index = {}
+        def add(value):
+            if value is None or value == b"" or value == "":
+                return (0, 0)
+            if isinstance(value, str):
+                value = value.encode("utf-8")
+            if value not in index:
+                index[value] = len(strings)
+                strings.extend(value)
+            return (index[value], len(value))
+
+        records = bytearray()
+        for e in entries:
+            refs = []
+            for ref in [add(e.key), add(e.opl_id), add(e.title), add(e.hash), \
+                    add(struct.pack("<%dQ" % len(e.parts), *e.parts))]:
+                refs.extend(ref)
+            records.extend(_record.pack(e.type, e.art, len(e.parts), e.crc32, e.size, \
+                    e.mtime, *refs))
+
+        try:
+            st = os.statvfs(self.opl_drive)
+            total, free = st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize
+        except OSError:
+            total, free = 0, 0
+        path_offset, path_len = add(os.path.abspath(self.opl_drive))
+        header = _header.pack(MAGIC, VERSION, 0, time.time_ns(), total, free, len(entries), \
+                _header.size, _header.size + len(records), len(strings), path_offset, path_len)
+
+        tmp = filepath + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header)
+            f.write(records)
+            f.write(strings)
+        os.replace(tmp, filepath)
+        return len(entries)
+
+
+####
+# Compare snapshots / a snapshot with a live drive
+# Return: list of (status, old SnapshotEntry, new SnapshotEntry)
+#  status: "+" added, "-" removed, "~" changed
+def diff_entries(old, new):
+    old = sorted((e for e in old if e.type != SnapshotEntry.DIR), key=lambda e: e.key)
+    new = sorted((e for e in new if e.type != SnapshotEntry.DIR), key=lambda e: e.key)
+    changes = []
+    i = j = 0
+    while i < len(old) or j < len(new):
+        if j >= len(new) or (i < len(old) and old[i].key < new[j].key):
+            changes.append(("-", old[i], None))
+            i += 1
+        elif i >= len(old) or new[j].key < old[i].key:
+            changes.append(("+", None, new[j]))
+            j += 1
+        else:
+            if old[i].compare(new[j]):
+                changes.append(("~", old[i], new[j]))
+            i += 1
+            j += 1
+    return changes
+
+def diff_snapshots(old, new):
+    return diff_entries(old, new)
+
+# Only folders whose mtime changed are listed; files are stat'ed when they
+# are new, or all files in changed folders with "full"
+def diff_live(snapshot, opl_drive, full=False):
+    dirs = snapshot.dirs()
+    def changed(d):
+        try:
+            return full or os.stat(os.path.join(opl_drive, d)).st_mtime_ns != dirs.get(d)
+        except OSError:
+            return d in dirs
+
+    old = snapshot.games()
+    new = [copy.copy(e) for e in old]
+    writer = SnapshotWriter(opl_drive)
+
+    # ISOs
+    for d in DriveCatalog.ISO_DIRS:
+        if not changed(d):
+            continue
+        known = dict((e.key, e) for e in new if e.type == SnapshotEntry.ISO and \
+                e.key.startswith(d + "/"))
+        new = [e for e in new if e.key not in known]
+        dirpath = os.path.join(opl_drive, d)
+        names = os.listdir(dirpath) if os.path.isdir(dirpath) else []
+        for name in names:
+            if not DriveCatalog.iso_regex.match(name):
+                continue
+            key = d + "/" + name
+            if key in known and not full:
+                new.append(known[key])
+                continue
+            try:
+                entry = SnapshotWriter.iso_entry(d, name, os.stat(os.path.join(dirpath, name)))
+            except OSError:
+                continue
+            if key in known:
+                entry.hash = known[key].hash
+            new.append(entry)
+
+    # UL-Games: ul.cfg & parts in drive root
+    if changed("ul.cfg") or changed("."):
+        hashes = dict((e.key, e.hash) for e in new if e.type == SnapshotEntry.UL)
+        new = [e for e in new if e.type != SnapshotEntry.UL] + writer.scan_ul()
+        for e in new:
+            if e.type == SnapshotEntry.UL and e.key in hashes:
+                e.hash = hashes[e.key]
+
+    # Artwork flags, only listed if ART/ changed or for games new to the snapshot
+    art = dict((e.opl_id, e.art) for e in old)
+    if changed("ART") or any(e.opl_id not in art for e in new):
+        art = writer.artwork()
+    for e in new:
+        e.art = art.get(e.opl_id, 0)
+
+    return diff_entries(old, new)
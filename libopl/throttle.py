@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+###
+# Bandwidth throttling
+# Token-bucket rate limiters, so ingests can run on shared hosts
+# at a fixed share of disk & network bandwidth.
+#
+# The module-level limiters "read", "write" (bytes/s) and "http" (requests/s)
+# are used by default by FileCopier and API, and can be changed at runtime:
+#
+#   from libopl import throttle
+#   throttle.set_limits(read_mbs=50, write_mbs=20, http_rps=5)
+import threading
+import time
+
+
+class RateLimiter():
+    # Tokens per second, None = unlimited
+    rate = None
+
+    # Max. tokens that can pile up while idle (Default: 1 second worth)
+    burst = None
+
+    def __init__(self, rate=None, burst=None):
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.set_rate(rate, burst)
+
+    # Change the rate at runtime, takes effect for the next consume()
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            if rate is not None and rate <= 0:
+                rate = None
+            self.rate = rate
+            self.burst = burst if burst else rate
+            self.tokens = min(self.tokens, self.burst) if self.burst else 0.0
+            self.last = time.monotonic()
+
+    # Take "amount" tokens, sleeps until they are available.
+    # Big requests (e.g. a 8MiB chunk) are allowed to go into debt,
+    # the following callers wait until it's paid back.
+    def consume(self, amount=1):
+        with self.lock:
+            if not self.rate:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+# Shared limiters
+read = RateLimiter()
+write = RateLimiter()
+http = RateLimiter()
+
+
+# Set limits in MB/s (read, write) and requests/s (http)
+# None keeps the current limit, 0 disables it
+def set_limits(read_mbs=None, write_mbs=None, http_rps=None):
+    if read_mbs is not None:
+        read.set_rate(read_mbs * 1024 * 1024)
+    if write_mbs is not None:
+        write.set_rate(write_mbs * 1024 * 1024)
+    if http_rps is not None:
+        http.set_rate(http_rps)
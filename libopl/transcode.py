@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+#####
+# Artwork Transcoder
+# Resizes & re-encodes artwork to the dimensions/format OPL recommends,
+# keeps ART/ small & makes browsing on the PS2 faster.
+#
+# Needs Pillow (pip3 install Pillow), transcoding is disabled without it.
+# Images are processed in a process pool, results are kept in the
+# ArtworkCache by source hash, so every image is only transcoded once.
+from concurrent.futures import ProcessPoolExecutor
+
+import io
+import os
+import hashlib
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# OPL artwork: art_type: (width, height, filetype)
+ART_FORMATS = {
+    "COV":  (140, 200, "jpg"),
+    "COV2": (242, 344, "jpg"),
+    "BG":   (640, 480, "jpg"),
+    "ICO":  (64, 64, "png"),
+    "LAB":  (18, 240, "jpg"),
+    "LGO":  (300, 125, "png"),
+    "SCR":  (250, 188, "jpg"),
+    "SCR2": (250, 188, "jpg"),
+}
+
+
+# Resize & re-encode single image, runs in worker process
+# Return: image data
+def transcode(content, art_type):
+    width, height, filetype = ART_FORMATS[art_type]
+    img = Image.open(io.BytesIO(content))
+    out = io.BytesIO()
+    if filetype == "png":
+        img = img.convert("RGBA").resize((width, height), Image.LANCZOS)
+        img.save(out, "PNG", optimize=True)
+    else:
+        img = img.convert("RGB").resize((width, height), Image.LANCZOS)
+        img.save(out, "JPEG", quality=90, optimize=True)
+    return out.getvalue()
+
+
+class Transcoder():
+    # ArtworkCache for transcoded images
+    cache = None
+    workers = None
+    pool = None
+
+    def __init__(self, cache=None, workers=None):
+        if not Image:
+            raise ImportError("Pillow is required for transcoding artwork")
+        self.cache = cache
+        self.workers = workers if workers else os.cpu_count()
+
+    @staticmethod
+    def available():
+        return Image is not None
+
+    # Does art_type have a recommended format?
+    def supports(self, art_type):
+        return art_type in ART_FORMATS
+
+    # Target filetype of art_type
+    def filetype(self, art_type, default=None):
+        if art_type in ART_FORMATS:
+            return ART_FORMATS[art_type][2]
+        return default
+
+    def __key(self, content, art_type):
+        return "transcode:%s:%s" % (hashlib.sha256(content).hexdigest(), art_type)
+
+    # Transcode list of (content, art_type)
+    # Return: list of image data (None if transcoding failed), same order
+    def transcode_many(self, images):
+        results = [None] * len(images)
+        jobs = {}
+        for i, (content, art_type) in enumerate(images):
+            if not self.supports(art_type):
+                results[i] = content
+                continue
+            if self.cache:
+                filepath = self.cache.get(self.__key(content, art_type))
+                if filepath:
+                    with open(filepath, 'rb') as f:
+                        results[i] = f.read()
+                    continue
+            jobs[i] = (content, art_type)
+
+        if not jobs:
+            return results
+
+        if not self.pool:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        futures = dict((i, self.pool.submit(transcode, *job)) for i, job in jobs.items())
+        for i, future in futures.items():
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                print(" -> Error transcoding %s artwork:" % jobs[i][1])
+                print(e)
+                continue
+            if self.cache:
+                self.cache.put(self.__key(*jobs[i]), results[i])
+        return results
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
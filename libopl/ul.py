@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 #from game import ULGameImage
-from libopl.common import usba_crc32
+from libopl.common import usba_crc32, is_file
 from libopl.game import ULGameImage
 
+import os
+
 # single game in ul.cfg / on filesyystem?
 # ul.cfg is binary
 # 64byte per game
@@ -39,14 +41,15 @@ class ULConfigGame():
     def __init__(self, data=None, game=None):
         # data = from ul.cfg
         if data:
-            self.name = data[:32].decode("utf-8") 
-            self.region_code = data[32:46].decode("utf-8") 
+            # Strip \0-padding, OPL's CRC32 stops at the first \0
+            self.name = data[:32].decode("utf-8").split('\0')[0]
+            self.region_code = data[32:46].decode("utf-8").rstrip('\0')
             self.parts = bytes([data[47]])
             self.media = bytes([data[48]])
             self.unknown = bytes([data[49]]).decode("utf8")
             self.remains = data[49:64].decode("utf-8")
 
-            self.opl_id = self.region_code[2:]
+            self.opl_id = self.region_code[3:]
         # Create ul.cfg-entry for new game
         elif game:
             self.game = game
@@ -87,7 +90,7 @@ class ULConfigGame():
         data += self.__get_bytes(self.media, 1)
         data += self.__get_bytes(self.remains, 12)
 
-        return data.ljust(63, '\x00'.encode('utf-8'))
+        return data.ljust(64, b"\0")[:64]
 
         
 # ul.cfg handling class
@@ -100,8 +103,8 @@ class ULConfig():
     # Generate ULconfig using ULGameConfig objects
     # Or Read ULConfig from filepath
     def __init__(self, filepath=None, ulgames=None):
-        if ulgames:
-            self.ulgames = ulgames
+        # Own dict per instance, don't share games between drives
+        self.ulgames = ulgames if ulgames else {}
 
         if filepath:
             self.filepath = filepath
@@ -114,6 +117,10 @@ class ULConfig():
     def add_ulgame(self, ul_id, ulgame):
         self.ulgames.update({ul_id: ulgame})
 
+    # Remove Game by ul_ID ("ul." + OPL_ID)
+    def remove_ulgame(self, ul_id):
+        return self.ulgames.pop(ul_id, None)
+
     # Print debug data
     def dump(self):
         print("Filepath: " +  str(self.filepath))
@@ -123,6 +130,8 @@ class ULConfig():
     
     # Read ul.cfg file
     def read(self):
+        if not is_file(self.filepath):
+            return False
         try:
             with open(self.filepath, 'rb') as data:
                 while True:
@@ -137,11 +146,17 @@ class ULConfig():
         return True
 
     # Write back games to ul.cfg
+    # Written to a temp file first & renamed, so ul.cfg is either
+    # the old or the new one, never half-written
     def write(self):
         if not self.filepath: 
             return False
 
-        with open(self.filepath, 'wb+') as cfg:
+        tmp = self.filepath + ".tmp"
+        with open(tmp, 'wb+') as cfg:
             for id in self.ulgames:
                 cfg.write(self.ulgames[id].get_binary_data())
+            cfg.flush()
+            os.fsync(cfg.fileno())
+        os.replace(tmp, self.filepath)
         return True
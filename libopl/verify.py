@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+###
+# UL-Game verification
+# Cross-checks ul.cfg against the ul.<CRC32>.<OPL_ID>.<PART> files on a drive.
+#
+#  fast: one directory scan, file sizes only
+#  deep: additionally reads & hashes every part (in parallel)
+#        and checks the ISO9660 volume descriptor of part 00
+from concurrent.futures import ThreadPoolExecutor
+from libopl.common import is_file, usba_crc32
+from libopl.catalog import DriveCatalog
+from libopl.fileio import drop_cache
+from libopl.game import ULGameImage
+from libopl.ul import ULConfig
+
+import os
+import re
+import struct
+import hashlib
+
+
+####
+# Result for a single ul.cfg entry (or orphaned part files)
+class ULVerifyResult():
+    def __init__(self, opl_id, name=None, crc32=None):
+        self.opl_id = opl_id
+        self.name = name
+        self.crc32 = crc32
+        # {part_number: size}
+        self.parts = {}
+        # {part_number: sha1}, deep mode only
+        self.hashes = {}
+        self.problems = []
+
+    def ok(self):
+        return not self.problems
+
+    def problem(self, msg):
+        self.problems.append(msg)
+
+
+class ULVerifier():
+    region_regex = re.compile(r'^ul\.[A-Z]{4}_\d{3}\.\d{2}$')
+
+    # ISO9660 primary volume descriptor at sector 16
+    PVD_OFFSET = 16 * 2048
+
+    READ_SIZE = 8 * 1024 * 1024
+
+    opl_drive = None
+    chunk_size = None
+
+    def __init__(self, opl_drive, chunk_size=None):
+        self.opl_drive = opl_drive
+        self.chunk_size = chunk_size if chunk_size else ULGameImage.get_chunk_size()
+
+    def part_path(self, crc32, opl_id, part):
+        return os.path.join(self.opl_drive, "ul.%s.%s.%02X" % (crc32, opl_id, part))
+
+    # Fast check: ul.cfg vs. directory listing & sizes
+    # Return: list of ULVerifyResult
+    def verify(self):
+        results = []
+        filepath = os.path.join(self.opl_drive, "ul.cfg")
+        # Single scan of drive root
+        files = DriveCatalog(self.opl_drive).scan_ul_parts()
+
+        if not is_file(filepath):
+            ulgames = {}
+        else:
+            if os.path.getsize(filepath) % 64:
+                r = ULVerifyResult("ul.cfg")
+                r.problem("ul.cfg size isn't a multiple of 64 bytes, it's probably damaged")
+                results.append(r)
+            ulcfg = ULConfig(filepath)
+            ulcfg.read()
+            ulgames = ulcfg.ulgames
+
+        seen = set()
+        for region_code, ulgame in ulgames.items():
+            crc32 = "%08X" % usba_crc32(ulgame.name)
+            r = ULVerifyResult(ulgame.opl_id, ulgame.name, crc32)
+            results.append(r)
+
+            if not self.region_regex.match(region_code):
+                r.problem("Unusual region code '%s'" % region_code)
+
+            key = (crc32, ulgame.opl_id)
+            if key in seen:
+                r.problem("Duplicate entry in ul.cfg")
+            seen.add(key)
+
+            found = files.get(key, {})
+            r.parts = dict(found)
+            if not found:
+                # Files exist, but for a different title?
+                other = [c for (c, id) in files if id == ulgame.opl_id and c != crc32]
+                if other:
+                    r.problem("Title CRC32 mismatch: files use %s, title '%s' gives %s" \
+                            % (", ".join(other), ulgame.name, crc32))
+                else:
+                    r.problem("No part files found")
+                continue
+
+            count = ulgame.parts[0] if isinstance(ulgame.parts, bytes) else int(ulgame.parts)
+            missing = [p for p in range(count) if p not in found]
+            extra = sorted(p for p in found if p >= count)
+            if missing:
+                r.problem("Missing part(s): %s" % ", ".join("%02X" % p for p in missing))
+            if extra:
+                r.problem("Part count in ul.cfg is %d, but found extra part(s): %s" \
+                        % (count, ", ".join("%02X" % p for p in extra)))
+
+            last = max(found)
+            for p, size in sorted(found.items()):
+                if p < last and size != self.chunk_size:
+                    r.problem("Part %02X has %d bytes, expected %d" % (p, size, self.chunk_size))
+                elif p == last and not 0 < size <= self.chunk_size:
+                    r.problem("Last part %02X has invalid size %d" % (p, size))
+
+        # Part files without ul.cfg entry
+        for (crc32, opl_id), found in sorted(files.items()):
+            if (crc32, opl_id) in seen:
+                continue
+            r = ULVerifyResult(opl_id, None, crc32)
+            r.parts = dict(found)
+            r.problem("Orphaned part file(s) without ul.cfg entry: ul.%s.%s.*" % (crc32, opl_id))
+            results.append(r)
+        return results
+
+    # Read & hash a single part
+    # Return: (sha1 hexdigest, first bytes incl. PVD) or raises OSError
+    def hash_part(self, filepath):
+        sha1 = hashlib.sha1()
+        head = b''
+        offset = 0
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            while True:
+                data = os.read(fd, ULVerifier.READ_SIZE)
+                if not data:
+                    break
+                if not head:
+                    head = data[:ULVerifier.PVD_OFFSET + 2048]
+                sha1.update(data)
+                drop_cache(fd, offset, len(data))
+                offset += len(data)
+        finally:
+            os.close(fd)
+        return sha1.hexdigest(), head
+
+    # Deep check: fast check + read/hash all parts in parallel
+    def verify_deep(self, workers=4):
+        results = self.verify()
+        jobs = []
+        for r in results:
+            if not r.name:
+                continue
+            for p in sorted(r.parts):
+                jobs.append((r, p, self.part_path(r.crc32, r.opl_id, p)))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [(r, p, pool.submit(self.hash_part, filepath)) for r, p, filepath in jobs]
+            for r, p, future in futures:
+                try:
+                    r.hashes[p], head = future.result()
+                except OSError as e:
+                    r.problem("Error reading part %02X: %s" % (p, e))
+                    continue
+                if p == 0:
+                    self.__check_pvd(r, head)
+        return results
+
+    # Part 00 has to start with an ISO9660 image, big enough for its volume size
+    def __check_pvd(self, r, head):
+        pvd = head[ULVerifier.PVD_OFFSET:ULVerifier.PVD_OFFSET + 2048]
+        if len(pvd) < 2048 or pvd[1:6] != b'CD001':
+            r.problem("Part 00 doesn't contain an ISO9660 volume descriptor")
+            return
+        blocks = struct.unpack('<L', pvd[80:84])[0]
+        block_size = struct.unpack('<H', pvd[128:130])[0] or 2048
+        if blocks * block_size > sum(r.parts.values()):
+            r.problem("Parts are smaller (%d bytes) than the ISO volume (%d bytes)" \
+                    % (sum(r.parts.values()), blocks * block_size))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+###
+# Virtual Memory Cards
+# Creates formatted PS2 memory card images (no ECC) for OPL's VMC/ folder.
+#
+# A freshly formatted card only has a few KB of metadata:
+#   superblock (cluster 0), indirect FAT & FAT (from cluster 8 on),
+#   root directory (first allocatable cluster) & the two backup blocks
+# These are built once per card size & written into a preallocated file,
+# the rest of the image is never touched.
+from libopl.common import is_file, is_dir
+from libopl.fileio import preallocate
+
+import os
+import re
+import time
+import struct
+
+PAGE_SIZE = 512
+PAGES_PER_CLUSTER = 2
+PAGES_PER_BLOCK = 16
+CLUSTER_SIZE = PAGE_SIZE * PAGES_PER_CLUSTER
+CLUSTERS_PER_BLOCK = PAGES_PER_BLOCK // PAGES_PER_CLUSTER
+BLOCK_SIZE = PAGE_SIZE * PAGES_PER_BLOCK
+
+# First indirect FAT cluster, block 0 only holds the superblock
+IFC_START = 8
+
+# FAT entries
+FAT_FREE = 0x7FFFFFFF
+FAT_EOC = 0xFFFFFFFF
+
+# Directory modes
+DF_ROOT = 0x8427
+DF_PARENT = 0xA426
+
+# magic, version, page_len, pages_per_cluster, pages_per_block, unused,
+# clusters_per_card, alloc_offset, alloc_end, rootdir_cluster,
+# backup_block1, backup_block2, unused, ifc_list[32], bad_block_list[32],
+# card_type, card_flags
+_superblock = struct.Struct("<28s12sHHHHIIIIII8x32I32IBB")
+
+# mode, unused, length, created, cluster, dir_entry, modified, attr,
+# unused, name
+_dirent = struct.Struct("<HHI8sII8sI28x32s")
+
+
+# PS2 time of day (JST)
+def _tod(timestamp):
+    t = time.gmtime(timestamp + 9 * 3600)
+    return struct.pack("<BBBBBBH", 0, t.tm_sec, t.tm_min, t.tm_hour, t.tm_mday, t.tm_mon, t.tm_year)
+
+
+class VMCImage():
+    # Sizes in MB supported by OPL
+    SIZES = [8, 16, 32, 64]
+
+    size = None
+
+    # size: card size in MB
+    def __init__(self, size=8):
+        if size not in VMCImage.SIZES:
+            raise ValueError("Unsupported VMC size %dMB, use one of: %s" \
+                    % (size, ", ".join(str(s) for s in VMCImage.SIZES)))
+        self.size = size
+        self.template = None
+
+    # Card geometry, everything in clusters
+    def layout(self):
+        clusters = (self.size << 20) // CLUSTER_SIZE
+        entries_per_cluster = CLUSTER_SIZE // 4
+        fat_clusters = -(-clusters // entries_per_cluster)
+        ifc_clusters = -(-fat_clusters // entries_per_cluster)
+        blocks = clusters // CLUSTERS_PER_BLOCK
+        # Last two blocks are reserved for backups
+        backup_block1 = blocks - 1
+        backup_block2 = blocks - 2
+        alloc_offset = IFC_START + ifc_clusters + fat_clusters
+        return {
+            "clusters": clusters,
+            "fat_clusters": fat_clusters,
+            "ifc_clusters": ifc_clusters,
+            "alloc_offset": alloc_offset,
+            "alloc_end": backup_block2 * CLUSTERS_PER_BLOCK - alloc_offset,
+            "backup_block1": backup_block1,
+            "backup_block2": backup_block2,
+        }
+
+    # Build metadata regions of a formatted card
+    # Return: list of (offset, bytes)
+    def build(self, timestamp=None):
+        l = self.layout()
+        if timestamp is None:
+            timestamp = time.time()
+
+        ifc_list = [IFC_START + i for i in range(l["ifc_clusters"])]
+        superblock = _superblock.pack(b"Sony PS2 Memory Card Format ", b"1.2.0.0", \
+                PAGE_SIZE, PAGES_PER_CLUSTER, PAGES_PER_BLOCK, 0xFF00, \
+                l["clusters"], l["alloc_offset"], l["alloc_end"], 0, \
+                l["backup_block1"], l["backup_block2"], \
+                *(ifc_list + [0] * (32 - len(ifc_list))), *([FAT_EOC] * 32), 2, 0x52)
+
+        # Indirect FAT points to the FAT clusters, which follow right after it
+        fat_start = IFC_START + l["ifc_clusters"]
+        ifc = struct.pack("<%dI" % l["fat_clusters"], \
+                *range(fat_start, fat_start + l["fat_clusters"]))
+        ifc = ifc.ljust(l["ifc_clusters"] * CLUSTER_SIZE, b"\0")
+
+        # Every cluster free, but the root directory's
+        fat = [FAT_FREE] * (l["fat_clusters"] * CLUSTER_SIZE // 4)
+        fat[0] = FAT_EOC
+        fat = struct.pack("<%dI" % len(fat), *fat)
+
+        tod = _tod(timestamp)
+        root = _dirent.pack(DF_ROOT, 0, 2, tod, 0, 0, tod, 0, b".").ljust(PAGE_SIZE, b"\0") + \
+                _dirent.pack(DF_PARENT, 0, 0, tod, 0, 0, tod, 0, b"..").ljust(PAGE_SIZE, b"\0")
+
+        return [
+            (0, superblock),
+            (IFC_START * CLUSTER_SIZE, ifc + fat),
+            (l["alloc_offset"] * CLUSTER_SIZE, root),
+            # Backup blocks are erased
+            (l["backup_block2"] * BLOCK_SIZE, b"\xff" * (2 * BLOCK_SIZE)),
+        ]
+
+    # Write formatted card to filepath
+    # Return: True on success
+    def create(self, filepath, force=False):
+        if is_file(filepath) and not force:
+            print("Warn: VMC '%s' already exists! Use -f to force overwriting." % filepath)
+            return False
+        if not self.template:
+            self.template = self.build()
+
+        size = self.size << 20
+        fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # Contiguous & zeroed without writing it, else sparse
+            if not preallocate(fd, size):
+                os.ftruncate(fd, size)
+            for offset, data in self.template:
+                os.pwrite(fd, data, offset)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return True
+
+
+####
+# Set VMC "name" (without .bin) as memory card "slot" (0 or 1) for opl_id
+# in OPL's per-game config CFG/<opl_id>.cfg
+def assign_vmc(opl_drive, opl_id, name, slot=0):
+    cfg_dir = os.path.join(opl_drive, "CFG")
+    if not is_dir(cfg_dir):
+        os.mkdir(cfg_dir)
+    filepath = os.path.join(cfg_dir, opl_id + ".cfg")
+    key = "$VMC_%d" % slot
+
+    lines = []
+    if is_file(filepath):
+        with open(filepath, "r") as f:
+            lines = [l for l in f.read().splitlines() if not re.match(re.escape(key) + "=", l)]
+    lines.append("%s=%s" % (key, name))
+
+    tmp = filepath + ".tmp"
+    with open(tmp, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, filepath)
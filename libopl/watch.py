@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+###
+# Drop-Folder Watcher
+# Waits for finished images in a folder using Linux inotify (no polling,
+# no CPU while idle) & hands them to a pool of workers via a bounded queue.
+#
+# Images count as finished when they were closed after writing
+# (IN_CLOSE_WRITE) or moved into the folder (IN_MOVED_TO) and their size
+# didn't change for "debounce" seconds (e.g. writers reopening the file).
+import os
+import re
+import time
+import queue
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+# inotify event masks (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event: wd, mask, cookie, len, name[len]
+_event = struct.Struct("iIII")
+
+
+####
+# Minimal inotify binding using libc
+class Inotify():
+    fd = None
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    # Wait up to "timeout" seconds (None = forever) for events,
+    # or until "wakeup_fd" becomes readable
+    # Return: list of (wd, mask, name)
+    def read(self, timeout=None, wakeup_fd=None):
+        fds = [self.fd] if wakeup_fd is None else [self.fd, wakeup_fd]
+        ready, _, _ = select.select(fds, [], [], timeout)
+        if self.fd not in ready:
+            return []
+        buf = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = _event.unpack_from(buf, offset)
+            offset += _event.size
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class DropFolderWatcher():
+    # Files picked up from the drop folder
+    image_regex = re.compile(r'.*\.[iI][sS][oO]$')
+
+    dropdir = None
+    handler = None
+    workers = None
+    debounce = None
+
+    # handler(filepath) is called by one of "workers" threads per image
+    def __init__(self, dropdir, handler, workers=1, queue_size=16, debounce=0.5):
+        self.dropdir = dropdir
+        self.handler = handler
+        self.workers = workers
+        self.debounce = debounce
+        self.queue = queue.Queue(maxsize=queue_size)
+        # name: (deadline, size)
+        self.pending = {}
+        # Images queued or already there at start, name: (size, mtime_ns)
+        # A rescan skips them unless they changed since
+        self.known = {}
+        self.threads = []
+        self.stopped = threading.Event()
+        # stop() writes to this pipe to wake up run()
+        self.wakeup = os.pipe()
+
+    def __size(self, name):
+        try:
+            return os.path.getsize(os.path.join(self.dropdir, name))
+        except OSError:
+            return None
+
+    def __stat(self, name):
+        try:
+            st = os.stat(os.path.join(self.dropdir, name))
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    # Images in drop folder that aren't known or pending
+    def __scan(self):
+        names = []
+        for name in sorted(os.listdir(self.dropdir)):
+            if self.image_regex.match(name) and name not in self.pending and \
+                    self.known.get(name) != self.__stat(name):
+                names.append(name)
+        return names
+
+    # Image written/moved, (re-)start debounce timer
+    def __touch(self, name):
+        self.pending[name] = (time.monotonic() + self.debounce, self.__size(name))
+
+    # Queue all images that are due & didn't change in the meantime
+    # Return: seconds until the next deadline, None if nothing is pending
+    def __flush(self):
+        now = time.monotonic()
+        for name, (deadline, size) in list(self.pending.items()):
+            if deadline > now:
+                continue
+            current = self.__size(name)
+            if current is None:
+                del self.pending[name]
+            elif current != size:
+                # Still growing
+                self.__touch(name)
+            else:
+                del self.pending[name]
+                self.known[name] = self.__stat(name)
+                # Blocks while the queue is full
+                self.queue.put(os.path.join(self.dropdir, name))
+        if not self.pending:
+            return None
+        return max(0, min(d for d, s in self.pending.values()) - time.monotonic())
+
+    def __worker(self):
+        while True:
+            filepath = self.queue.get()
+            if filepath is None:
+                self.queue.task_done()
+                break
+            try:
+                self.handler(filepath)
+            except Exception as e:
+                print("Error while ingesting '%s':" % filepath)
+                print(e)
+            finally:
+                self.queue.task_done()
+
+    # Watch until stop() is called (or KeyboardInterrupt)
+    # existing: also ingest images that are already in the drop folder
+    def run(self, existing=False):
+        inotify = Inotify()
+        inotify.add_watch(self.dropdir, IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE)
+
+        for i in range(self.workers):
+            t = threading.Thread(target=self.__worker, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+        for name in self.__scan():
+            if existing:
+                self.__touch(name)
+            else:
+                self.known[name] = self.__stat(name)
+
+        try:
+            timeout = self.__flush()
+            while not self.stopped.is_set():
+                for wd, mask, name in inotify.read(timeout, self.wakeup[0]):
+                    if mask & IN_Q_OVERFLOW:
+                        # Lost events, rescan folder for new images
+                        for n in self.__scan():
+                            self.__touch(n)
+                        continue
+                    if not self.image_regex.match(name):
+                        continue
+                    if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        self.__touch(name)
+                    elif mask & (IN_MOVED_FROM | IN_DELETE):
+                        self.pending.pop(name, None)
+                        self.known.pop(name, None)
+                timeout = self.__flush()
+        finally:
+            inotify.close()
+            for t in self.threads:
+                self.queue.put(None)
+            for t in self.threads:
+                t.join()
+            self.threads = []
+
+    def stop(self):
+        self.stopped.set()
+        os.write(self.wakeup[1], b'x')